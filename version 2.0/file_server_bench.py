@@ -0,0 +1,400 @@
+"""Load benchmark for local_file_server.py.
+
+Starts the server on loopback against a generated fixture tree, drives
+concurrent workloads through it and writes the results as JSON:
+
+    python file_server_bench.py run --out before.json
+    python file_server_bench.py run --out after.json --workers 4
+    python file_server_bench.py compare before.json after.json
+
+The fixture (a folder per listing size plus a media folder of small and
+large files) is generated from a fixed seed and kept in --fixture, so
+repeated runs see the same tree and the server's hash index sidecar is
+already warm after the first one. Client and server share the machine:
+only compare runs made on the same machine with the same options.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    import psutil  # optional: RSS on Windows and of the worker processes everywhere
+except ImportError:
+    psutil = None
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_file_server.py")
+FIXTURE_DIR = os.path.join(tempfile.gettempdir(), "lanshare-bench")
+FIXTURE_SEED = 20240501  # changing it changes every generated file
+LISTING_SIZES = (10, 10000, 100000)  # entries in the generated listing folders
+SMALL_FILES = 200  # files between SMALL_MIN and SMALL_MAX bytes in /media/
+SMALL_MIN = 1024
+SMALL_MAX = 256 * 1024
+LARGE_FILES = 2  # files of --large-mb MiB in /media/
+RANGE_SIZE = 1024 * 1024  # bytes per ranged request
+UPLOAD_SIZE = 256 * 1024  # bytes per uploaded file
+READ_SIZE = 1024 * 1024  # bytes read from a response at a time
+PASSWORD = "bench"  # handed to the server through LANSHARE_PASSWORD
+RSS_INTERVAL = 0.5  # seconds between server memory samples
+METRICS = (  # result key -> True when higher is better
+    ("rps", True), ("mb_per_s", True), ("received_mb_per_s", True), ("sent_mb_per_s", True),
+    ("p50_ms", False), ("p95_ms", False), ("p99_ms", False),
+    ("errors", False), ("rss_peak_mb", False),
+)
+
+def write_file(path, size, rng):
+    with open(path, "wb") as f:
+        left = size
+        while left > 0:
+            n = min(left, READ_SIZE)
+            f.write(rng.randbytes(n))
+            left -= n
+
+def build_fixture(root, large_mb):
+    """Create the fixture tree unless root already holds one made with the same options"""
+    spec = {"seed": FIXTURE_SEED, "listings": LISTING_SIZES, "small": SMALL_FILES,
+            "large": LARGE_FILES, "large_mb": large_mb}
+    marker = os.path.join(root, "fixture.json")
+    try:
+        with open(marker) as f:
+            if json.load(f) == json.loads(json.dumps(spec)):
+                return
+    except (OSError, ValueError):
+        pass
+    print(f"Generating fixture in {root} ...")
+    shutil.rmtree(root, ignore_errors=True)
+    rng = random.Random(FIXTURE_SEED)
+    for count in LISTING_SIZES:
+        folder = os.path.join(root, f"list-{count}")
+        os.makedirs(folder)
+        for i in range(count):
+            # mostly empty files with a few folders, like a photo or document dump
+            if i % 50 == 0:
+                os.mkdir(os.path.join(folder, f"folder-{i:06d}"))
+            else:
+                open(os.path.join(folder, f"file-{i:06d}.{rng.choice(('jpg', 'txt', 'pdf', 'mp3'))}"), "wb").close()
+    media = os.path.join(root, "media")
+    os.makedirs(media)
+    for i in range(SMALL_FILES):
+        write_file(os.path.join(media, f"small-{i:04d}.bin"), rng.randint(SMALL_MIN, SMALL_MAX), rng)
+    for i in range(LARGE_FILES):
+        write_file(os.path.join(media, f"large-{i}.bin"), large_mb * 1024 * 1024, rng)
+    with open(marker, "w") as f:
+        json.dump(spec, f)
+
+class Server:
+    """local_file_server.py in headless mode as a child process"""
+    def __init__(self, root, port, workers):
+        env = dict(os.environ, LANSHARE_PASSWORD=PASSWORD, LANSHARE_USERNAME="admin")
+        self.process = subprocess.Popen(
+            [sys.executable, SERVER_SCRIPT, "--root", root, "--port", str(port), "--bind", "127.0.0.1",
+             "--workers", str(workers)],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP if os.name == "nt" else 0)  # for CTRL_BREAK
+        self.port = port
+
+    def wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"server exited with code {self.process.returncode}")
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=2)
+                conn.request("GET", "/api/list?path=/&limit=1")
+                conn.getresponse().read()
+                conn.close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("server did not start")
+
+    def rss(self):
+        """Resident memory of the server and its worker processes, in bytes (None if unknown)"""
+        if psutil is not None:
+            try:
+                parent = psutil.Process(self.process.pid)
+                return sum(p.memory_info().rss for p in [parent] + parent.children(recursive=True))
+            except psutil.Error:
+                return None
+        pids, total = [self.process.pid], 0
+        while pids:
+            pid = pids.pop()
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    total += next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+                with open(f"/proc/{pid}/task/{pid}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except (OSError, StopIteration, ValueError):
+                if pid == self.process.pid:
+                    return None  # no /proc, e.g. Windows without psutil
+        return total
+
+    def stop(self):
+        self.process.send_signal(signal.SIGINT if os.name != "nt" else signal.CTRL_BREAK_EVENT)
+        try:
+            self.process.wait(60)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+class Client:
+    """One benchmark thread's connection; reconnects whenever the server closes it"""
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        self.cookie = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Send one request and read the whole response; returns (status, body bytes read, body bytes sent)"""
+        headers = dict(headers or {})
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()  # a kept-alive connection the server dropped: retry once on a new one
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+        size = 0
+        while True:
+            data = response.read(READ_SIZE)
+            if not data:
+                break
+            size += len(data)
+        cookie = response.getheader("Set-Cookie")
+        if cookie and cookie.startswith("session_token="):
+            self.cookie = cookie.split(";", 1)[0]
+        if response.will_close:
+            self.conn.close()
+        return response.status, size, len(body or b"")
+
+    def login(self):
+        body = json.dumps({"username": "admin", "password": PASSWORD})
+        return self.request("POST", "/login", body, {"Content-Type": "application/json"})
+
+    def batch(self, ops):
+        body = json.dumps({"dir": "/bench-ops/", "ops": ops})
+        return self.request("POST", "/api/batch", body, {"Content-Type": "application/json"})
+
+    def close(self):
+        self.conn.close()
+
+def multipart(name, data):
+    boundary = uuid.uuid4().hex
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    return head + data + f"\r\n--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+def make_workloads(large_mb):
+    """name -> step(client, rng) returning a list of (status, bytes read, bytes sent) for the requests it made"""
+    small = [f"/media/small-{i:04d}.bin" for i in range(SMALL_FILES)]
+    large = [f"/media/large-{i}.bin" for i in range(LARGE_FILES)]
+    large_size = large_mb * 1024 * 1024
+    payload = random.Random(FIXTURE_SEED).randbytes(UPLOAD_SIZE)
+
+    def listing(count):
+        return lambda client, rng: [client.request("GET", f"/api/list?path=/list-{count}/")]
+
+    def ranged(client, rng):
+        start = rng.randrange(0, large_size - RANGE_SIZE)
+        return [client.request("GET", rng.choice(large), headers={"Range": f"bytes={start}-{start + RANGE_SIZE - 1}"})]
+
+    def upload(client, rng):
+        body, ctype = multipart(f"up-{uuid.uuid4().hex}.bin", payload)
+        return [client.request("POST", "/bench-uploads/", body, {"Content-Type": ctype})]
+
+    def file_ops(client, rng):
+        if client.cookie is None:
+            client.login()
+        a, b = f"op-{uuid.uuid4().hex}", f"op-{uuid.uuid4().hex}"
+        return [client.batch([{"op": "mkdir", "name": a}]),
+                client.batch([{"op": "rename", "name": a, "to": b}]),
+                client.batch([{"op": "delete", "name": b}])]
+
+    workloads = {f"list-{count}": listing(count) for count in LISTING_SIZES}
+    workloads.update({
+        "download-small": lambda client, rng: [client.request("GET", rng.choice(small))],
+        "download-large": lambda client, rng: [client.request("GET", rng.choice(large))],
+        "download-range": ranged,
+        "upload": upload,
+        "login": lambda client, rng: [client.login()],
+        "file-ops": file_ops,
+    })
+    return workloads
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+def run_workload(server, step, concurrency, duration):
+    latencies, errors, received, sent = [], [0], [0], [0]
+    lock = threading.Lock()
+    stop = threading.Event()
+    rss = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = Client(server.port)
+        try:
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    results = step(client, rng)
+                except (http.client.HTTPException, OSError):
+                    results = [(0, 0, 0)]
+                elapsed = time.perf_counter() - started
+                with lock:
+                    # a step making several requests counts each one at the step's average latency
+                    latencies.extend([elapsed / len(results)] * len(results))
+                    errors[0] += sum(1 for status, _, _ in results if not 200 <= status < 400)
+                    received[0] += sum(size for _, size, _ in results)
+                    sent[0] += sum(size for _, _, size in results)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(FIXTURE_SEED + i,), daemon=True) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while time.perf_counter() - started < duration:
+        time.sleep(RSS_INTERVAL)
+        sample = server.rss()
+        if sample is not None:
+            rss.append(sample)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    ordered = sorted(latencies)
+    ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "requests": len(ordered),
+        "errors": errors[0],
+        "seconds": round(seconds, 3),
+        "rps": round(len(ordered) / seconds, 2),
+        "mb_per_s": round((received[0] + sent[0]) / seconds / 1e6, 2),  # body bytes both ways
+        "received_mb_per_s": round(received[0] / seconds / 1e6, 2),
+        "sent_mb_per_s": round(sent[0] / seconds / 1e6, 2),
+        "p50_ms": ms(percentile(ordered, 0.50)),
+        "p95_ms": ms(percentile(ordered, 0.95)),
+        "p99_ms": ms(percentile(ordered, 0.99)),
+        "rss_peak_mb": round(max(rss) / 1e6, 1) if rss else None,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(SERVER_SCRIPT),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def cmd_run(args):
+    workloads = make_workloads(args.large_mb)
+    selected = args.workload or list(workloads)
+    unknown = [name for name in selected if name not in workloads]
+    if unknown:
+        sys.exit(f"Unknown workload(s): {', '.join(unknown)}; choose from {', '.join(workloads)}")
+    build_fixture(args.fixture, args.large_mb)
+    for folder in ("bench-uploads", "bench-ops"):
+        shutil.rmtree(os.path.join(args.fixture, folder), ignore_errors=True)
+        os.makedirs(os.path.join(args.fixture, folder))
+
+    server = Server(args.fixture, args.port, args.workers)
+    results = {}
+    try:
+        server.wait_ready()
+        time.sleep(args.warmup)  # let the search and hash indexes settle
+        for name in selected:
+            results[name] = run_workload(server, workloads[name], args.concurrency, args.duration)
+            r = results[name]
+            print(f"{name:16} {r['rps']:9.1f} req/s {r['mb_per_s']:9.1f} MB/s  p50 {r['p50_ms']} ms"
+                  f"  p95 {r['p95_ms']} ms  p99 {r['p99_ms']} ms  errors {r['errors']}"
+                  f"  rss {r['rss_peak_mb']} MB")
+    finally:
+        server.stop()
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "options": {"workers": args.workers, "concurrency": args.concurrency,
+                        "duration": args.duration, "large_mb": args.large_mb},
+        },
+        "workloads": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.out}")
+    return 0
+
+def cmd_compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if base["meta"]["options"] != new["meta"]["options"]:
+        print(f"Warning: the runs used different options: {base['meta']['options']} vs {new['meta']['options']}")
+    regressions = 0
+    print(f"{'workload':16} {'metric':12} {'base':>12} {'new':>12} {'change':>9}")
+    for name, old in base["workloads"].items():
+        current = new["workloads"].get(name)
+        if current is None:
+            print(f"{name:16} missing from {args.new}")
+            continue
+        for key, higher_is_better in METRICS:
+            a, b = old.get(key), current.get(key)
+            if a is None or b is None:
+                continue
+            if key == "errors":
+                worse = b > a
+                change = f"{b - a:+d}"
+            else:
+                delta = (b - a) / a * 100 if a else 0.0
+                worse = (-delta if higher_is_better else delta) > args.threshold
+                change = f"{delta:+.1f}%"
+            regressions += worse
+            print(f"{name:16} {key:12} {a:>12.6g} {b:>12.6g} {change:>9}" + ("  REGRESSION" if worse else ""))
+    print(f"{regressions} regression(s) beyond {args.threshold}%" if regressions else "No regressions")
+    return 1 if regressions else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark local_file_server.py on loopback.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="start the server, drive the workloads and report")
+    run.add_argument("--out", help="write the results to this JSON file")
+    run.add_argument("--workload", action="append",
+                     help="run only this workload (repeatable); default: all")
+    run.add_argument("--concurrency", type=int, default=8, help="client threads per workload (default 8)")
+    run.add_argument("--duration", type=float, default=10, help="seconds per workload (default 10)")
+    run.add_argument("--warmup", type=float, default=2, help="seconds to wait after the server is up (default 2)")
+    run.add_argument("--workers", type=int, default=1, help="server worker processes (default 1)")
+    run.add_argument("--port", type=int, default=8765, help="loopback port for the server (default 8765)")
+    run.add_argument("--large-mb", type=int, default=64, dest="large_mb", help="size of the large files (default 64)")
+    run.add_argument("--fixture", default=FIXTURE_DIR, help=f"fixture folder, reused between runs (default {FIXTURE_DIR})")
+    run.set_defaults(handler=cmd_run)
+    compare = commands.add_parser("compare", help="compare two result files; exit status 1 on regressions")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=10, help="percent change counted as a regression (default 10)")
+    compare.set_defaults(handler=cmd_compare)
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
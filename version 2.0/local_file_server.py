@@ -1,8 +1,6 @@
 import http.server
 import socketserver
 import threading
-import tkinter as tk
-from tkinter import filedialog, messagebox
 import socket
 import os
 import time
@@ -13,59 +11,3173 @@ from io import StringIO
 import base64
 import hashlib
 import secrets
+import email.utils
+import email.message
+import shutil
+import bisect
+import itertools
+import heapq
+from array import array
+import urllib.parse
+import argparse
+import signal
+import subprocess
+import multiprocessing
+import multiprocessing.connection
+import gzip
+import zlib
+import mmap
+import sqlite3
+import zipfile
+import mimetypes
+import ctypes
+import ctypes.util
+import select
+import struct
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError  # not the builtin before Python 3.11
+from collections import deque, OrderedDict
+
+try:
+    import tkinter as tk  # optional: the App window; headless mode runs without it
+    from tkinter import filedialog, messagebox
+except ImportError:
+    tk = None
+
+try:
+    from PIL import Image, ImageOps  # optional: enables image thumbnails
+except ImportError:
+    Image = None
+
+try:
+    import brotli  # optional: br content-encoding next to gzip
+except ImportError:
+    brotli = None
+
+FFMPEG = shutil.which("ffmpeg")  # optional: enables video posters
 
 PORT = 8000
+BIND_ADDRESS = ""  # all interfaces
 server_thread = None
 FOLDER_SELECTED = None
 AUTH_USERNAME = "admin"
 AUTH_PASSWORD = "password"  # Default password
-SESSION_TOKENS = {}
+SESSION_TTL = 3600  # seconds a login stays valid
+MAX_SESSIONS = 1000  # live sessions kept; the least recently used go first beyond this
+SESSION_SWEEP_INTERVAL = 60  # seconds between sweeps for expired sessions
+
+# Concurrency settings
+MAX_CONNECTIONS = 32  # client connections served at the same time
+MAX_PENDING_CONNECTIONS = 64  # accepted connections allowed to wait for a worker
+WORKER_PROCESSES = 1  # headless serving processes sharing the port; 0 = one per CPU core
+WORKER_START_TIMEOUT = 60  # seconds a new worker process may take to start serving
+WORKER_DRAIN_TIMEOUT = 30  # seconds a stopping worker process may spend finishing open requests
+MAX_TRANSFERS = 8  # large downloads/uploads running at the same time
+LARGE_TRANSFER_SIZE = 4 * 1024 * 1024  # bytes; smaller files skip the transfer cap
+TRANSFER_WAIT = 30  # seconds to wait for a free transfer slot
+CONNECTION_TIMEOUT = 60  # seconds a client may stall before being dropped
+KEEPALIVE_TIMEOUT = 15  # seconds an idle kept-alive connection may wait for its next request
+KEEPALIVE_MAX_REQUESTS = 500  # requests served on one connection before it is closed
+TRANSFER_SLOTS = threading.BoundedSemaphore(MAX_TRANSFERS)
+SCHED_QUANTUM = 512 * 1024  # bytes a large transfer may send per scheduler grant
+SCHED_CONCURRENCY = 2  # grants being written to sockets at the same time
+GLOBAL_RATE_LIMIT = 0  # bytes/s across all large transfers; 0 = unlimited
+CLIENT_RATE_LIMIT = 0  # bytes/s per client address; 0 = unlimited
+CLIENT_WEIGHTS = {}  # client address -> share weight (default 1), e.g. {"192.168.1.10": 2}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # seconds
+STATS_REFRESH_MS = 2000  # how often the App window's summary panel is redrawn
+MAX_RANGES = 16  # byte ranges honoured in one request before falling back to the full file
+SENDFILE_CHUNK = 8 * 1024 * 1024  # bytes handed to the kernel per sendfile call
+COPY_BUFFER_SIZE = 1024 * 1024  # bytes per read when sendfile is unavailable (e.g. Windows)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes read from the socket per multipart parsing step
+MAX_PART_HEADER_SIZE = 16 * 1024  # bytes allowed for one part's headers
+MAX_FIELD_SIZE = 64 * 1024  # bytes allowed for a plain (non-file) form field
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024  # bytes per chunk in the resumable upload API
+RESUMABLE_EXPIRY = 7 * 24 * 3600  # seconds an untouched, unfinished resumable upload is kept
+UPLOAD_WRITE_BUFFER = 8 * 1024 * 1024  # bytes of an upload gathered before each write to disk
+UPLOAD_PREALLOCATE = True  # reserve an upload's disk space up front (Linux fallocate, NTFS end of file)
+UPLOAD_STALE_AGE = 3600  # seconds after which an untouched upload temp file counts as abandoned
+UPLOAD_SWEEP_INTERVAL = 6 * 3600  # seconds between sweeps for abandoned uploads
+HASH_RESCAN_INTERVAL = 3600  # seconds between background sweeps of the content-hash index
+DEDUP_HARDLINK = False  # hard-link duplicate uploads instead of copying (both names then share one file)
+INTERNAL_PREFIX = ".lanshare-"  # files and folders the server keeps for itself
+HASH_DB_NAME = INTERNAL_PREFIX + "hashes.db"  # content-hash sidecar in the shared root
+LISTING_CACHE_SIZE = 256  # folders whose listings are kept in memory
+LIST_PAGE_SIZE = 200  # entries per /api/list page unless the client asks otherwise
+LIST_PAGE_LIMIT = 1000  # most entries one /api/list call may return
+SEARCH_RESCAN_INTERVAL = 600  # seconds between full rebuilds of the filename index
+SEARCH_RESULT_LIMIT = 100  # most results one /api/search call may return
+SEARCH_CANDIDATE_LIMIT = 5000  # matches collected and scored per search; broader queries report a capped total
+MAX_BATCH_OPS = 1000  # operations accepted in one /api/batch request
+MAX_EVENT_STREAMS = 8  # live /api/events streams; each one holds a worker thread
+EVENT_QUEUE_SIZE = 256  # events buffered per stream before the client is told to reload
+EVENT_HEARTBEAT = 15  # seconds between keep-alive comments on an idle event stream
+WATCH_POLL_INTERVAL = 2  # seconds between folder rescans when inotify is unavailable
+
+# Thumbnail settings
+CACHE_DIR = os.path.join(os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache"),
+                         "LanFileShare")
+THUMB_SIZE = 200  # pixels on the longest side (2x the 100px preview column)
+THUMB_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # processes rendering thumbnails
+THUMB_WAIT = 10  # seconds a /thumb/ request waits for its thumbnail to render
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp')
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.mkv', '.mov', '.avi')
+
+# HTTP caching: Cache-Control per content type, longest matching prefix wins.
+# Files can change in place, so everything is revalidated with ETag/Last-Modified;
+# media just gets a grace period before the browser asks again.
+CACHE_POLICIES = {
+    "": "no-cache",
+    "image/": "public, max-age=3600",
+    "video/": "public, max-age=3600",
+    "audio/": "public, max-age=3600",
+    "font/": "public, max-age=86400",
+}
+LISTING_CACHE_POLICY = "private, no-cache"  # listings depend on the login state
+STATIC_PREFIX = "/__app__/"  # versioned CSS/JS of the page shell
+INSTANCE_ID = secrets.token_hex(4)  # keeps listing validators from one run out of the next
+HOT_CACHE_BUDGET = 32 * 1024 * 1024  # bytes of small, often requested files kept in memory; 0 = off
+HOT_CACHE_MAX_FILE = 256 * 1024  # bytes; larger files are read from disk on every request
+HOT_CACHE_MMAP_MAX = 0  # bytes; files up to this size are memory-mapped instead (Windows then blocks deleting them)
+
+# Compression settings
+MIN_COMPRESS_SIZE = 1024  # bytes; smaller bodies are sent as they are
+MAX_COMPRESS_FILE = 32 * 1024 * 1024  # bytes; larger text files are sent uncompressed
+COMPRESS_SETTLE_TIME = 10  # seconds; files modified more recently (growing logs) are sent uncompressed
+COMPRESS_CACHE_LIMIT = 512 * 1024 * 1024  # bytes of compressed file variants kept on disk
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml",
+                      "application/x-javascript", "image/svg+xml", "application/x-sh",
+                      "application/rtf", "application/x-yaml", "application/sql")
+
+# ZIP download settings
+ZIP_BUFFER_SIZE = 256 * 1024  # bytes gathered before each socket write while zipping
+MAX_ZIP_REQUEST = 1024 * 1024  # bytes of selection accepted by POST /download-zip
+
+class TextRedirector:
+    def __init__(self, widget, tag="stdout"):
+        self.widget = widget
+        self.tag = tag
+
+    def write(self, text):
+        self.widget.after(0, lambda: self.widget.insert(tk.END, text))
+        self.widget.after(0, lambda: self.widget.see(tk.END))
+
+    def flush(self):
+        pass
+
+class TransferStats:
+    """Throughput counters for file bodies, split by copy method"""
+    def __init__(self, keep=50):
+        self.lock = threading.Lock()
+        self.totals = {}  # method -> [transfers, bytes, seconds]
+        self.recent = deque(maxlen=keep)
+
+    def record(self, method, client, nbytes, seconds):
+        with self.lock:
+            totals = self.totals.setdefault(method, [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += nbytes
+            totals[2] += seconds
+            self.recent.append((time.time(), client, method, nbytes, seconds))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                method: {
+                    "transfers": count,
+                    "bytes": nbytes,
+                    "seconds": round(seconds, 3),
+                    "mb_per_s": round(nbytes / seconds / 1e6, 1) if seconds else 0.0,
+                }
+                for method, (count, nbytes, seconds) in self.totals.items()
+            }
+
+TRANSFER_STATS = TransferStats()
+
+class TokenBucket:
+    """Byte-rate limiter refilled continuously up to one second's worth of tokens"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, nbytes):
+        """Seconds until nbytes could be taken (0 when they can be taken now)"""
+        self.refill()
+        return max(0.0, min(nbytes, self.rate) - self.tokens) / self.rate
+
+    def reserve(self, nbytes):
+        """Take nbytes now, going into debt if needed; returns the seconds to wait"""
+        self.refill()
+        self.tokens -= nbytes
+        return max(0.0, -self.tokens / self.rate)
+
+class ClientShare:
+    def __init__(self, weight):
+        self.weight = weight
+        self.finish = 0.0  # virtual finish tag of this client's latest grant
+        self.waiting = 0
+        self.granted = 0
+
+class TransferScheduler:
+    """Weighted fair queueing over the write loops of large transfers.
+
+    Every SCHED_QUANTUM a large transfer asks for a grant. Grants are
+    handed out in order of virtual finish tag (self-clocked fair queueing),
+    and the tag is kept per client address, not per connection. So a
+    client gets its weighted share of the disk and NIC however many
+    downloads it opens. Up to SCHED_CONCURRENCY grants are written at once.
+    A grant only covers what the socket takes without blocking: senders
+    wait for their socket to become writable before asking, and give back
+    the part of a grant the kernel did not accept, so a client that stops
+    reading holds no slot. The optional per-client and global token buckets
+    cap the rates on top; a client's bucket outlives its idle periods and
+    is only dropped once it has refilled.
+
+    Small responses (listings, thumbnails, API calls, files under
+    LARGE_TRANSFER_SIZE) never pass through here: they are the priority lane.
+    """
+    def __init__(self, concurrency=SCHED_CONCURRENCY):
+        self.concurrency = concurrency
+        self.cond = threading.Condition()
+        self.clients = {}
+        self.buckets = {}  # client -> TokenBucket, kept apart from the fair-queueing state
+        self.queue = []  # heap of (tag, sequence)
+        self.sequence = itertools.count()
+        self.virtual = 0.0
+        self.in_flight = 0
+        self.global_bucket = TokenBucket(GLOBAL_RATE_LIMIT) if GLOBAL_RATE_LIMIT else None
+
+    def acquire(self, client, nbytes):
+        """Block until client may send nbytes; pair every call with release()"""
+        with self.cond:
+            share = self.clients.get(client)
+            if share is None:
+                share = self.clients[client] = ClientShare(CLIENT_WEIGHTS.get(client, 1))
+            share.waiting += 1
+            bucket = self.buckets.get(client)
+            if bucket is None and CLIENT_RATE_LIMIT:
+                bucket = self.buckets[client] = TokenBucket(CLIENT_RATE_LIMIT)
+            delay = bucket.reserve(nbytes) if bucket else 0.0
+        if delay:
+            time.sleep(delay)
+        with self.cond:
+            tag = max(self.virtual, share.finish) + nbytes / share.weight
+            share.finish = tag
+            ticket = (tag, next(self.sequence))
+            heapq.heappush(self.queue, ticket)
+            while True:
+                if self.queue[0] == ticket and self.in_flight < self.concurrency:
+                    # pace at the head of the queue, so a ticket with a smaller tag can still overtake
+                    delay = self.global_bucket.wait_time(nbytes) if self.global_bucket else 0.0
+                    if not delay:
+                        break
+                    self.cond.wait(delay)
+                else:
+                    self.cond.wait()
+            heapq.heappop(self.queue)
+            if self.global_bucket:
+                self.global_bucket.reserve(nbytes)
+            self.in_flight += 1
+            self.virtual = tag
+            share.waiting -= 1
+            share.granted += nbytes
+            self.cond.notify_all()  # the next ticket may fit in a free slot too
+
+    def release(self, client, unused=0):
+        """End a grant; unused is the part of it that was not sent"""
+        with self.cond:
+            self.in_flight -= 1
+            share = self.clients.get(client)
+            if unused:
+                if share is not None:
+                    share.finish -= unused / share.weight
+                    share.granted -= unused
+                if client in self.buckets:
+                    self.buckets[client].tokens += unused
+                if self.global_bucket:
+                    self.global_bucket.tokens += unused
+            if share is not None and not share.waiting and share.finish <= self.virtual:
+                del self.clients[client]  # idle: a returning client starts from the current virtual time
+            for idle in [c for c in self.buckets if c not in self.clients]:
+                bucket = self.buckets[idle]
+                bucket.refill()
+                if bucket.tokens >= bucket.rate:
+                    del self.buckets[idle]  # refilled: a fresh bucket would be the same
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                "in_flight": self.in_flight,
+                "queued": len(self.queue),
+                "clients": {client: {"weight": share.weight, "waiting": share.waiting, "granted": share.granted}
+                            for client, share in self.clients.items()},
+            }
+
+SCHEDULER = TransferScheduler()
+
+class MetricFamily:
+    """One named metric with any number of label combinations"""
+    def __init__(self, name, kind, help_text, labels=(), buckets=None, collect=None):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.collect = collect  # callable returning the value(s) at scrape time
+        self.values = {}  # label values -> number, or [bucket counts, sum, count] for histograms
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def observe(self, value, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1  # slower than the last bound: only in +Inf
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        """(label values, value) pairs; histograms give (counts, sum, count) as the value"""
+        if self.collect is not None:
+            value = self.collect()
+            return list(value.items()) if isinstance(value, dict) else [((), value)]
+        with self.lock:
+            return [(labels, (list(v[0]), v[1], v[2]) if self.kind == "histogram" else v)
+                    for labels, v in self.values.items()]
+
+    def quantile(self, q, *labels):
+        """Estimate a quantile from the buckets (upper bound of the bucket it falls in)"""
+        with self.lock:
+            entry = self.values.get(labels)
+            if not entry or not entry[2]:
+                return None
+            rank = q * entry[2]
+            seen = 0
+            for bound, count in zip(self.buckets, entry[0]):
+                seen += count
+                if seen >= rank:
+                    return bound
+            return float("inf")
+
+def format_labels(names, values, *extra):
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(pair for pair in extra if pair)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class MetricsRegistry:
+    """Counters, gauges and histograms, rendered in the Prometheus text format at /metrics"""
+    def __init__(self):
+        self.families = OrderedDict()
+        self.constant_labels = ""  # added to every sample, e.g. worker="2" in a worker process
+
+    def add(self, name, kind, help_text, labels=(), buckets=None, collect=None):
+        family = self.families[name] = MetricFamily(name, kind, help_text, labels, buckets, collect)
+        return family
+
+    def render(self):
+        lines = []
+        const = self.constant_labels
+        for family in self.families.values():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for labels, value in family.samples():
+                if family.kind != "histogram":
+                    lines.append(f"{family.name}{format_labels(family.labels, labels, const)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, n in zip(family.buckets, counts):
+                    cumulative += n
+                    le = format_labels(family.labels, labels, const, f'le="{bound}"')
+                    lines.append(f"{family.name}_bucket{le} {cumulative}")
+                le = format_labels(family.labels, labels, const, 'le="+Inf"')
+                lines.append(f"{family.name}_bucket{le} {count}")
+                lines.append(f"{family.name}_sum{format_labels(family.labels, labels, const)} {total:.6f}")
+                lines.append(f"{family.name}_count{format_labels(family.labels, labels, const)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """A few lines for the App window"""
+        requests = dict(REQUESTS_TOTAL.samples())
+        total = sum(requests.values())
+        errors = sum(n for (route, status), n in requests.items() if status.startswith("5"))
+
+        def ms(family, *labels):
+            value = family.quantile(0.95, *labels)
+            return "-" if value is None else ("> 60 s" if value == float("inf") else f"{value * 1000:.0f} ms")
+
+        def rate(hits, misses):
+            return f"{100 * hits / (hits + misses):.0f}%" if hits + misses else "-"
+
+        sent = sum(n for _, n in BYTES_SENT.samples())
+        received = sum(n for _, n in BYTES_RECEIVED.samples())
+        transfers = "   ".join(f"{method}: {t['mb_per_s']} MB/s over {t['transfers']}"
+                               for method, t in sorted(TRANSFER_STATS.snapshot().items()))
+        return "\n".join([
+            f"Requests: {total}   5xx: {errors}   Active connections: {ACTIVE_CONNECTIONS.samples()[0][1]}",
+            f"p95 listing: {ms(REQUEST_SECONDS, 'list')}   first byte: {ms(FIRST_BYTE_SECONDS, 'file')}"
+            f"   upload: {ms(REQUEST_SECONDS, 'upload_api')}",
+            f"Sent: {sent / 1e6:.1f} MB   Received: {received / 1e6:.1f} MB",
+            f"File bodies - {transfers or 'none sent yet'}",
+            f"Cache hits - listings: {rate(LISTING_CACHE.hits, LISTING_CACHE.misses)}"
+            f"   thumbnails: {rate(THUMBNAILS.hits, THUMBNAILS.misses)}"
+            f"   compressed: {rate(COMPRESSED_FILES.hits, COMPRESSED_FILES.misses)}"
+            f"   hot files: {rate(HOT_FILES.hits, HOT_FILES.misses)} of {HOT_FILES.size / 1e6:.1f} MB",
+        ])
+
+METRICS = MetricsRegistry()
+REQUESTS_TOTAL = METRICS.add("lanshare_requests_total", "counter", "Requests handled, by route and status",
+                             ("route", "status"))
+REQUEST_SECONDS = METRICS.add("lanshare_request_duration_seconds", "histogram",
+                              "Time from request line to the end of the response, by route",
+                              ("route",), LATENCY_BUCKETS)
+FIRST_BYTE_SECONDS = METRICS.add("lanshare_download_first_byte_seconds", "histogram",
+                                 "Time from request line to the first body byte of a download",
+                                 ("kind",), LATENCY_BUCKETS)
+BYTES_SENT = METRICS.add("lanshare_bytes_sent_total", "counter", "Response bytes written, by route", ("route",))
+BYTES_RECEIVED = METRICS.add("lanshare_bytes_received_total", "counter",
+                             "Request body bytes received, by route", ("route",))
+ACTIVE_CONNECTIONS = METRICS.add("lanshare_active_connections", "gauge", "Connections being served",
+                                 collect=lambda: 0)
+METRICS.add("lanshare_cache_hits_total", "counter", "Cache lookups answered from the cache", ("cache",),
+            collect=lambda: {("listing",): LISTING_CACHE.hits, ("thumbnail",): THUMBNAILS.hits,
+                             ("compressed",): COMPRESSED_FILES.hits, ("hot_file",): HOT_FILES.hits})
+METRICS.add("lanshare_cache_misses_total", "counter", "Cache lookups that had to build the entry", ("cache",),
+            collect=lambda: {("listing",): LISTING_CACHE.misses, ("thumbnail",): THUMBNAILS.misses,
+                             ("compressed",): COMPRESSED_FILES.misses, ("hot_file",): HOT_FILES.misses})
+METRICS.add("lanshare_hot_file_cache_bytes", "gauge", "Bytes of file contents held in the hot-file cache",
+            collect=lambda: HOT_FILES.size)
+METRICS.add("lanshare_sessions", "gauge", "Live login sessions", collect=lambda: SESSIONS.stats()["live"])
+METRICS.add("lanshare_search_index_entries", "gauge", "Files and folders in the search index",
+            collect=lambda: SEARCH_INDEX.stats()["entries"])
+METRICS.add("lanshare_hashed_files_total", "counter", "Files hashed by the content-hash index",
+            collect=lambda: HASH_INDEX.hashed)
+METRICS.add("lanshare_event_streams", "gauge", "Open /api/events streams", collect=lambda: CHANGE_FEED.count)
+METRICS.add("lanshare_scheduler_queued", "gauge", "Large-transfer grants waiting in the scheduler",
+            collect=lambda: SCHEDULER.snapshot()["queued"])
+METRICS.add("lanshare_transfers_total", "counter", "File bodies sent, by copy method (sendfile, copy, zip)",
+            ("method",), collect=lambda: {(method,): t["transfers"] for method, t in TRANSFER_STATS.snapshot().items()})
+METRICS.add("lanshare_transfer_bytes_total", "counter", "File body bytes sent, by copy method", ("method",),
+            collect=lambda: {(method,): t["bytes"] for method, t in TRANSFER_STATS.snapshot().items()})
+METRICS.add("lanshare_transfer_seconds_total", "counter", "Seconds spent sending file bodies, by copy method",
+            ("method",), collect=lambda: {(method,): t["seconds"] for method, t in TRANSFER_STATS.snapshot().items()})
+
+ROUTE_PREFIXES = (
+    ("/api/upload/", "upload_api"), ("/api/list", "list"), ("/api/search", "search"),
+    ("/api/events", "events"), ("/api/batch", "batch"), ("/download-zip", "zip"),
+    ("/thumb/", "thumbnail"), (STATIC_PREFIX, "static"), ("/metrics", "metrics"),
+    ("/login", "auth"), ("/logout", "auth"), ("/delete", "file_op"), ("/rename", "file_op"),
+)
+
+def route_of(command, path):
+    """Low-cardinality route label for a request, used by the metrics"""
+    path = urllib.parse.urlsplit(path or "").path
+    for prefix, route in ROUTE_PREFIXES:
+        if path.startswith(prefix):
+            return route
+    if command == "POST":
+        return "upload"
+    if command in ("GET", "HEAD"):
+        return "folder" if path.endswith("/") else "file"
+    return "other"
+
+class CountingReader:
+    """Wraps a handler's rfile and counts the bytes read through it"""
+    def __init__(self, raw):
+        self.raw = raw
+        self.consumed = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.consumed += len(data)
+        return data
+
+    def readline(self, size=-1):
+        line = self.raw.readline(size)
+        self.consumed += len(line)
+        return line
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class CountingWriter:
+    """Wraps a handler's wfile and counts the bytes written through it"""
+    def __init__(self, raw):
+        self.raw = raw
+        self.written = 0
+
+    def write(self, data):
+        n = self.raw.write(data)
+        self.written += len(data) if n is None else n
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class ScheduledWriter:
+    """Passes writes of a large streamed body through the transfer scheduler"""
+    def __init__(self, handler, client):
+        self.handler = handler
+        self.client = client
+
+    def write(self, data):
+        view = memoryview(data)
+        sock = self.handler.connection
+        while view:
+            sent = self.handler.scheduled_send(self.client, min(len(view), SCHED_QUANTUM),
+                                               lambda n: sock.send(view[:n]))
+            view = view[sent:]
+        return len(data)
+
+class MultipartError(ValueError):
+    pass
+
+class MultipartReader:
+    """Streaming multipart/form-data parser with a fixed-size buffer.
+
+    Iterating yields the headers of each part; the part body is then pulled
+    with read_into() or read_value(), or skipped automatically when the
+    next part is requested. Memory use is bounded by the chunk size no
+    matter how large the uploaded files are.
+    """
+    def __init__(self, stream, boundary, length, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.stream = stream
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.delimiter = b"\r\n--" + boundary
+        # the body opens with "--boundary" without the CRLF, so seed one
+        self.buffer = bytearray(b"\r\n")
+        self.in_body = False
+        self.finished = False
+        self.bytes_read = 0
+
+    def fill(self):
+        if self.remaining <= 0:
+            return False
+        data = self.stream.read(min(self.chunk_size, self.remaining))
+        if not data:
+            raise MultipartError("Upload ended early")
+        self.remaining -= len(data)
+        self.bytes_read += len(data)
+        self.buffer += data
+        return True
+
+    def __iter__(self):
+        # skip the preamble up to the first delimiter
+        self.in_body = True
+        self.read_into(None)
+        return self
+
+    def __next__(self):
+        if self.in_body:
+            self.read_into(None)
+        if self.finished:
+            raise StopIteration
+        headers = self.read_headers()
+        self.in_body = True
+        return headers
+
+    def read_headers(self):
+        while True:
+            end = self.buffer.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+            if len(self.buffer) > MAX_PART_HEADER_SIZE:
+                raise MultipartError("Part headers too large")
+            if not self.fill():
+                raise MultipartError("Truncated part headers")
+        raw = bytes(self.buffer[:end]).decode("utf-8", "replace")
+        del self.buffer[:end + 4]
+        headers = {}
+        for line in raw.split("\r\n"):
+            key, sep, value = line.partition(":")
+            if sep:
+                headers[key.strip().lower()] = value.strip()
+        return headers
+
+    def read_into(self, write):
+        """Stream the current part body to write(); None discards it"""
+        if not self.in_body:
+            return
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if write and index:
+                    write(memoryview(self.buffer)[:index])
+                del self.buffer[:index + len(self.delimiter)]
+                break
+            if len(self.buffer) > keep:
+                if write:
+                    write(memoryview(self.buffer)[:len(self.buffer) - keep])
+                del self.buffer[:len(self.buffer) - keep]
+            if not self.fill():
+                raise MultipartError("Missing closing boundary")
+
+        while len(self.buffer) < 2 and self.fill():
+            pass
+        self.in_body = False
+        if self.buffer[:2] == b"--":
+            self.finished = True
+            self.drain()
+        elif self.buffer[:2] == b"\r\n":
+            del self.buffer[:2]
+        else:
+            raise MultipartError("Malformed boundary line")
+
+    def read_value(self):
+        chunks = []
+        size = 0
+
+        def collect(data):
+            nonlocal size
+            size += len(data)
+            if size > MAX_FIELD_SIZE:
+                raise MultipartError("Form field too large")
+            chunks.append(bytes(data))
+
+        self.read_into(collect)
+        return b"".join(chunks).decode("utf-8", "replace")
+
+    def drain(self):
+        """Discard the epilogue so the connection is left at a request boundary"""
+        self.buffer.clear()
+        while self.remaining > 0:
+            data = self.stream.read(min(self.chunk_size, self.remaining))
+            if not data:
+                break
+            self.remaining -= len(data)
+
+def parse_disposition(value):
+    """Return (field name, filename or None) from a Content-Disposition header"""
+    msg = email.message.Message()
+    msg["content-disposition"] = value
+    return (msg.get_param("name", header="content-disposition"),
+            msg.get_filename())
+
+def is_internal_name(name):
+    """Hide the server's own staging files from listings and downloads"""
+    return name.startswith(INTERNAL_PREFIX)
+
+def is_plain_name(name):
+    """True for a single path component that clients may create, touch or select"""
+    return (isinstance(name, str) and name not in ("", ".", "..") and not is_internal_name(name)
+            and not any(c in name for c in "/\\\0"))
+
+def plain_basename(value):
+    """Last path component of a name sent by a client, or None unless it is a plain name"""
+    if not isinstance(value, str):
+        return None
+    name = os.path.basename(value)
+    return name if is_plain_name(name) else None
+
+def safe_filename(name):
+    return re.sub(r'[\\/*?:"<>|]', "_", os.path.basename(name or ""))
+
+def partial_upload_path(folder):
+    """Hidden temp name in folder for a file being written; renamed into place when complete"""
+    return os.path.join(folder, INTERNAL_PREFIX + secrets.token_hex(8) + ".part")
+
+def is_partial_upload(name):
+    return re.fullmatch(re.escape(INTERNAL_PREFIX) + r"[0-9a-f]{16}\.part", name) is not None
+
+def preallocate(f, size):
+    """Reserve size bytes of disk for f before writing, where that costs no extra writes.
+
+    Linux fallocate() fails rather than writing zeros on file systems that
+    cannot do it (posix_fallocate would write them). On Windows, extending
+    the file reserves its clusters on NTFS. The caller truncates the file
+    to the bytes it actually wrote.
+    """
+    if not UPLOAD_PREALLOCATE or size < LARGE_TRANSFER_SIZE:
+        return
+    try:
+        if sys.platform.startswith("linux"):
+            fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+            fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+            fallocate(f.fileno(), 0, 0, size)
+        elif os.name == "nt":
+            f.truncate(size)
+    except (OSError, AttributeError):
+        pass  # no preallocation: the file simply grows as it is written
+
+class ResumableUploads:
+    """Chunked uploads staged under the shared root until they are complete.
+
+    Each upload keeps three files in the staging folder: <id>.part holds the
+    data at its final offsets, <id>.json the metadata and <id>.log one line
+    per finished chunk. Everything lives on disk, so an interrupted upload
+    can resume even after the server restarts.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    @property
+    def staging_dir(self):
+        return os.path.join(os.getcwd(), INTERNAL_PREFIX + "uploads")
+
+    def path(self, upload_id, ext):
+        if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+            raise KeyError(upload_id)
+        return os.path.join(self.staging_dir, upload_id + ext)
+
+    def create(self, name, size, target_dir, chunk_size=RESUMABLE_CHUNK_SIZE):
+        os.makedirs(self.staging_dir, exist_ok=True)
+        upload_id = secrets.token_hex(16)
+        meta = {
+            "id": upload_id,
+            "name": name,
+            "dir": os.path.relpath(target_dir, os.getcwd()),
+            "size": size,
+            "chunkSize": chunk_size,
+            "created": time.time(),
+        }
+        with open(self.path(upload_id, ".part"), "wb") as f:
+            f.truncate(size)
+        with open(self.path(upload_id, ".json"), "w") as f:
+            json.dump(meta, f)
+        return self.status(upload_id)
+
+    def meta(self, upload_id):
+        try:
+            with open(self.path(upload_id, ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise KeyError(upload_id)
+
+    def chunk_count(self, meta):
+        return -(-meta["size"] // meta["chunkSize"])
+
+    def received(self, upload_id):
+        try:
+            with open(self.path(upload_id, ".log")) as f:
+                return sorted({int(line) for line in f if line.strip().isdigit()})
+        except FileNotFoundError:
+            return []
+
+    def status(self, upload_id):
+        meta = self.meta(upload_id)
+        received = self.received(upload_id)
+        return dict(meta, received=received, complete=len(received) == self.chunk_count(meta))
+
+    def write_chunk(self, upload_id, offset, length, stream):
+        meta = self.meta(upload_id)
+        chunk_size = meta["chunkSize"]
+        if offset % chunk_size or offset + length > meta["size"]:
+            raise ValueError("Chunk is outside the upload")
+        if length != chunk_size and offset + length != meta["size"]:
+            raise ValueError("Only the last chunk may be short")
+        with open(self.path(upload_id, ".part"), "r+b") as f:
+            f.seek(offset)
+            left = length
+            while left > 0:
+                data = stream.read(min(UPLOAD_CHUNK_SIZE, left))
+                if not data:
+                    raise ConnectionError("Chunk ended early")
+                f.write(data)
+                left -= len(data)
+        with self.lock, open(self.path(upload_id, ".log"), "a") as log:
+            log.write(f"{offset // chunk_size}\n")
+
+    def complete(self, upload_id):
+        """Move a fully received upload into place; returns its final path"""
+        status = self.status(upload_id)
+        if not status["complete"]:
+            raise ValueError("Upload is missing chunks")
+        target = os.path.join(os.getcwd(), status["dir"], status["name"])
+        part = self.path(upload_id, ".part")
+        try:
+            os.replace(part, target)
+        except OSError:
+            shutil.move(part, target)  # target folder sits on another volume
+        self.discard(upload_id)
+        return target
+
+    def discard(self, upload_id):
+        for ext in (".part", ".json", ".log"):
+            try:
+                os.remove(self.path(upload_id, ext))
+            except FileNotFoundError:
+                pass
+
+    def sweep(self, max_age=RESUMABLE_EXPIRY):
+        """Discard uploads that received nothing for max_age seconds; returns how many"""
+        cutoff = time.time() - max_age
+        removed = 0
+        try:
+            names = os.listdir(self.staging_dir)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            upload_id, ext = os.path.splitext(name)
+            if ext != ".json":
+                continue
+            try:
+                touched = max(os.stat(self.path(upload_id, e)).st_mtime for e in (".part", ".json"))
+            except (OSError, KeyError):
+                continue
+            if touched < cutoff:
+                self.discard(upload_id)
+                removed += 1
+        return removed
+
+UPLOADS = ResumableUploads()
+
+class UploadSweeper:
+    """Removes what aborted uploads leave behind.
+
+    A failed request deletes its own temp file, but a crash or power cut
+    can leave .part files anywhere in the share. They are found by a walk
+    at startup and every UPLOAD_SWEEP_INTERVAL and removed once untouched
+    for UPLOAD_STALE_AGE. Resumable uploads idle for RESUMABLE_EXPIRY are
+    discarded on the same schedule.
+    """
+    def __init__(self, interval=UPLOAD_SWEEP_INTERVAL):
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.removed = 0
+
+    def start(self, root):
+        self.stop_event = threading.Event()
+
+        def run(stop_event):
+            while True:
+                self.sweep(root, stop_event)
+                if stop_event.wait(self.interval):
+                    break
+
+        self.thread = threading.Thread(target=run, args=(self.stop_event,), name="upload-sweeper", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def sweep(self, root, stop_event):
+        cutoff = time.time() - UPLOAD_STALE_AGE
+        removed = UPLOADS.sweep()
+        for dir_path, _, file_names in os.walk(root):
+            if stop_event.is_set():
+                return
+            for name in file_names:
+                if not is_partial_upload(name):
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        if removed:
+            self.removed += removed
+            print(f"Removed {removed} abandoned upload(s)")
+
+UPLOAD_SWEEPER = UploadSweeper()
+
+def hash_file(path, stop_event=None):
+    """SHA-256 hex digest of a file, or None if stop_event was set part way"""
+    digest = hashlib.sha256()
+    buf = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                return None
+            n = f.readinto(buf)
+            if not n:
+                return digest.hexdigest()
+            digest.update(view[:n])
+
+class HashIndex:
+    """SHA-256 of every file in the share, kept in a sqlite sidecar in the shared root.
+
+    A row is trusted while the file's size and mtime are unchanged, and a
+    moved file keeps its hash through its inode. Multipart uploads are
+    hashed as they stream in; everything else is hashed by one background
+    thread, at startup, after each change and every HASH_RESCAN_INTERVAL.
+    With several worker processes only the first one runs that thread.
+    Client-supplied hashes are never stored, only checked against the index.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()  # guards the shared sqlite connection
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.db = None
+        self.root = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.hashed = 0
+
+    def start(self, root, interval=HASH_RESCAN_INTERVAL, sweep=True):
+        self.root = os.path.abspath(root)
+        try:
+            db = sqlite3.connect(os.path.join(self.root, HASH_DB_NAME),
+                                 check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER,"
+                       " mtime_ns INTEGER, inode INTEGER, sha256 TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+            db.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size)")
+        except sqlite3.Error as e:
+            print(f"Content-hash index disabled: {e}")
+            return  # e.g. a read-only share
+        self.db = db
+        if not sweep:
+            return  # look up and record only; a sibling worker process does the hashing
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(interval, self.stop_event),
+                                       name="hash-index", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        with self.cond:
+            self.queue.clear()
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def rel(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, "/")
+
+    def query(self, sql, args=()):
+        with self.lock:
+            if self.db is None:
+                return []
+            return self.db.execute(sql, args).fetchall()
+
+    def record(self, path, sha256, st=None):
+        """Store the hash of a file the server has just written"""
+        st = st or os.stat(path)
+        self.query("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                   (self.rel(path), st.st_size, st.st_mtime_ns, st.st_ino, sha256))
+
+    def forget(self, path):
+        """Drop the rows for path and, if it was a folder, everything below it"""
+        rel = self.rel(path)
+        self.query("DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)",
+                   (rel, rel + "/", rel + "0"))  # "0" sorts right after "/"
+
+    def find(self, sha256, size):
+        """Path of a file in the share with this content, or None"""
+        for rel, mtime_ns in self.query("SELECT path, mtime_ns FROM files WHERE sha256 = ? AND size = ?",
+                                        (sha256, size)):
+            path = os.path.join(self.root, *rel.split("/"))
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size == size and st.st_mtime_ns == mtime_ns:
+                return path
+        return None
+
+    def has_size(self, size):
+        """Whether any indexed file has this size, i.e. hashing a candidate could pay off"""
+        return bool(self.query("SELECT 1 FROM files WHERE size = ? LIMIT 1", (size,)))
+
+    def changed(self, dir_path, names):
+        if self.thread is None:
+            return
+        with self.cond:
+            self.queue.extend(os.path.join(dir_path, name) for name in names)
+            self.cond.notify()
+
+    def ensure(self, path, stop_event):
+        st = os.stat(path)
+        if self.query("SELECT 1 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                      (self.rel(path), st.st_size, st.st_mtime_ns)):
+            return
+        known = st.st_ino and self.query(
+            "SELECT sha256 FROM files WHERE inode = ? AND size = ? AND mtime_ns = ? LIMIT 1",
+            (st.st_ino, st.st_size, st.st_mtime_ns))
+        sha256 = known[0][0] if known else hash_file(path, stop_event)
+        if sha256 is not None:
+            self.record(path, sha256, st)
+            self.hashed += 1
+
+    def prune(self):
+        """Forget files that disappeared while nobody was looking"""
+        for (rel,) in self.query("SELECT path FROM files"):
+            if not os.path.isfile(os.path.join(self.root, *rel.split("/"))):
+                self.query("DELETE FROM files WHERE path = ?", (rel,))
+
+    def run(self, interval, stop_event):
+        next_sweep = 0
+        while not stop_event.is_set():
+            if time.monotonic() >= next_sweep:
+                self.prune()
+                with self.cond:
+                    self.queue.append(self.root)
+                next_sweep = time.monotonic() + interval
+            with self.cond:
+                if not self.queue:
+                    self.cond.wait(max(0, next_sweep - time.monotonic()))
+                    continue
+                path = self.queue.popleft()
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    with os.scandir(path) as it:
+                        children = [entry.path for entry in it if not is_internal_name(entry.name)]
+                    with self.cond:
+                        self.queue.extend(children)
+                elif os.path.isfile(path):
+                    self.ensure(path, stop_event)
+                else:
+                    self.forget(path)
+            except (OSError, sqlite3.Error):
+                continue  # unreadable or busy; the next sweep retries it
+
+HASH_INDEX = HashIndex()
+
+class DirectoryListing:
+    """Snapshot of one folder: name -> (is_dir, size, mtime), plus derived views.
+
+    Never changed once published: readers use it without a lock, and a
+    change to the folder publishes a new snapshot with a higher version.
+    """
+    def __init__(self, path, mtime_ns, entries, version=0):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        self.version = version
+        self.derived = {}  # sorted names, rendered rows...
+
+    def sorted_names(self):
+        names = self.derived.get("names")
+        if names is None:
+            names = self.derived["names"] = sorted(self.entries, key=str.lower)
+        return names
+
+    def cached(self, key, build):
+        """Memoise something computed from this snapshot until it changes"""
+        value = self.derived.get(key)
+        if value is None:
+            value = self.derived[key] = build(self)
+        return value
+
+def scan_entry(entry):
+    """Listing row for one os.scandir entry (stat is free on Windows)"""
+    st = entry.stat()
+    is_dir = entry.is_dir()
+    return (is_dir, 0 if is_dir else st.st_size, st.st_mtime)
+
+class ListingCache:
+    """Per-folder listings built with os.scandir and keyed on the folder mtime.
+
+    A folder is rescanned only when its mtime moves without the server
+    knowing why. Changes the server makes itself (uploads, delete, rename)
+    are patched into a copy of the cached snapshot through update_entries(),
+    so the next request is served straight from memory.
+    """
+    def __init__(self, max_dirs=LISTING_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.max_dirs = max_dirs
+        self.dirs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def get(self, path):
+        key = self.key(path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self.lock:
+            listing = self.dirs.get(key)
+            if listing is not None and listing.mtime_ns == mtime_ns:
+                self.dirs.move_to_end(key)
+                self.hits += 1
+                return listing
+            self.misses += 1
+
+        entries = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                if is_internal_name(entry.name):
+                    continue
+                try:
+                    entries[entry.name] = scan_entry(entry)
+                except OSError:
+                    continue  # vanished or unreadable while scanning
+        with self.lock:
+            current = self.dirs.get(key)
+            fresh = DirectoryListing(key, mtime_ns, entries, current.version + 1 if current is not None else 0)
+            self.dirs[key] = fresh
+            self.dirs.move_to_end(key)
+            while len(self.dirs) > self.max_dirs:
+                self.dirs.popitem(last=False)
+        return fresh
+
+    def update_entries(self, dir_path, names):
+        """Re-read entries after the server changed them; drops the ones that are gone.
+
+        The patched copy only takes the folder's new mtime when its names
+        match the folder on disk. Otherwise another change happened
+        meanwhile, and the old mtime makes the next request rescan.
+        """
+        key = self.key(dir_path)
+        while True:
+            with self.lock:
+                listing = self.dirs.get(key)
+            if listing is None:
+                return
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns  # before listing, so a later change still moves it
+                on_disk = {name for name in os.listdir(dir_path) if not is_internal_name(name)}
+            except OSError:
+                self.invalidate(dir_path)  # let the next request rescan
+                return
+            entries = dict(listing.entries)
+            for name in names:
+                row = stat_entry(os.path.join(dir_path, name))
+                if row is None:
+                    entries.pop(name, None)
+                else:
+                    entries[name] = row
+            if on_disk != entries.keys():
+                mtime_ns = listing.mtime_ns
+            with self.lock:
+                if self.dirs.get(key) is listing:
+                    self.dirs[key] = DirectoryListing(key, mtime_ns, entries, listing.version + 1)
+                    return
+            # replaced meanwhile by a rescan or another update: patch that snapshot instead
+
+    def peek(self, dir_path, name):
+        """(whether the folder is cached, its row for name or None) without rescanning"""
+        with self.lock:
+            listing = self.dirs.get(self.key(dir_path))
+            if listing is None:
+                return False, None
+            return True, listing.entries.get(name)
+
+    def invalidate(self, dir_path):
+        with self.lock:
+            self.dirs.pop(self.key(dir_path), None)
+
+LISTING_CACHE = ListingCache()
+
+def thumbnail_kind(name):
+    lower = name.lower()
+    if lower.endswith(IMAGE_EXTENSIONS) and Image is not None:
+        return "image"
+    if lower.endswith(VIDEO_EXTENSIONS) and FFMPEG:
+        return "video"
+    return None
+
+def render_thumbnail(source, dest, kind, size):
+    """Runs in a worker process: write a JPEG preview of source to dest"""
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    try:
+        if kind == "image":
+            with Image.open(source) as im:
+                im.draft("RGB", (size, size))  # lets JPEG decode at reduced scale
+                im = ImageOps.exif_transpose(im)
+                im.thumbnail((size, size))
+                im.convert("RGB").save(tmp, "JPEG", quality=80, optimize=True)
+        else:
+            for seek in ("3", "0"):  # skip black intro frames unless the clip is too short
+                subprocess.run([FFMPEG, "-v", "error", "-y", "-ss", seek, "-i", source,
+                                "-frames:v", "1", "-vf", f"scale={size}:-2", "-f", "mjpeg", tmp],
+                               check=True, timeout=60, stdin=subprocess.DEVNULL,
+                               creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+                if os.path.getsize(tmp):
+                    break
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return dest
+
+class ThumbnailCache:
+    """Downscaled previews rendered in a process pool and kept on disk.
+
+    Thumbnails are keyed by path, mtime and size, so an edited file simply
+    gets a new cache entry. Requests for the same thumbnail while it is
+    rendering share one job.
+    """
+    def __init__(self, cache_dir, size=THUMB_SIZE, workers=THUMB_WORKERS):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pending = {}
+        self.failed = set()
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, source, fs):
+        key = hashlib.sha1(f"{os.path.abspath(source)}|{fs.st_mtime_ns}|{fs.st_size}|{self.size}"
+                           .encode("utf-8", "surrogateescape")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ".jpg")
+
+    def submit(self, source, fs, kind):
+        """Queue a render unless it is cached, running or known to fail; returns the future"""
+        dest = self.path_for(source, fs)
+        with self.lock:
+            if dest in self.failed:
+                return None
+            future = self.pending.get(dest)
+            if future is not None:
+                return future
+            if os.path.exists(dest):
+                return None
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            future = self.pool.submit(render_thumbnail, source, dest, kind, self.size)
+            self.pending[dest] = future
+        future.add_done_callback(lambda f: self.finished(dest, f))
+        return future
+
+    def finished(self, dest, future):
+        with self.lock:
+            self.pending.pop(dest, None)
+            if future.cancelled() or future.exception() is not None:
+                if len(self.failed) > 10000:
+                    self.failed.clear()
+                self.failed.add(dest)
+
+    def get(self, source, fs, kind, timeout=THUMB_WAIT):
+        """Path of the rendered thumbnail, waiting up to timeout for a render"""
+        dest = self.path_for(source, fs)
+        if os.path.exists(dest):
+            self.hits += 1
+            return dest
+        self.misses += 1
+        future = self.submit(source, fs, kind)
+        if future is not None:
+            future.result(timeout)  # TimeoutError or the render error propagate
+        if not os.path.exists(dest):
+            raise FileNotFoundError(dest)
+        return dest
+
+    def prefetch(self, folder, names):
+        """Start rendering thumbnails a listing page is about to ask for"""
+        for name in names:
+            kind = thumbnail_kind(name)
+            if kind:
+                try:
+                    source = os.path.join(folder, name)
+                    self.submit(source, os.stat(source), kind)
+                except OSError:
+                    pass
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+
+THUMBNAILS = ThumbnailCache(os.path.join(CACHE_DIR, "thumbs"))
+
+def sorted_listing(listing, sort, descending):
+    """Names of a listing ordered by name, size or mtime (cached per snapshot)"""
+    def build(listing):
+        if sort == "name":
+            names = listing.sorted_names()
+        else:
+            column = 1 if sort == "size" else 2
+            names = sorted(listing.entries, key=lambda n: (listing.entries[n][column], n.lower()))
+        return names[::-1] if descending else names
+    return listing.cached(("order", sort, descending), build)
+
+def filter_prefix(listing, names, sort, descending, prefix):
+    """Entries whose name starts with prefix (case-insensitive), keeping names' order"""
+    prefix = prefix.lower()
+    if sort != "name":
+        return [n for n in names if n.lower().startswith(prefix)]
+    # name order is sorted on the lowercased name, so the matches are one slice
+    lowered = listing.cached("lowered", lambda l: [n.lower() for n in l.sorted_names()])
+    lo = bisect.bisect_left(lowered, prefix)
+    hi = bisect.bisect_left(lowered, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    matches = listing.sorted_names()[lo:hi]
+    return matches[::-1] if descending else matches
+
+def search_terms(query):
+    return re.findall(r"\.?[^\W_]+", query.lower())
+
+def name_tokens(name):
+    """Index terms for a file name: its words plus its extension (".mp4")"""
+    lower = name.lower()
+    tokens = set(re.findall(r"[^\W_]+", lower))
+    ext = os.path.splitext(lower)[1]
+    if len(ext) > 1:
+        tokens.add(ext)
+    return tokens
+
+class NameIndexData:
+    """One generation of the filename index.
+
+    Every file and folder gets an integer id; its path is stored as
+    (parent id, name) so shared folder prefixes are kept once. Postings map
+    each token to a compact array of ids. Removing an entry only flags it
+    dead, and a rebuild starts from a fresh generation.
+    """
+    def __init__(self):
+        self.parents = array('i', [-1])
+        self.names = [""]
+        self.dirs = bytearray(b"\x01")
+        self.alive = bytearray(b"\x01")
+        self.children = {0: {}}
+        self.postings = {}
+        self.sorted_tokens = []
+        self.tokens_dirty = False
+        self.live = 0
+
+    def add(self, parent_id, name, is_dir):
+        """Insert parent/name; returns (id, whether it is new)"""
+        siblings = self.children[parent_id]
+        existing = siblings.get(name)
+        if existing is not None:
+            if self.dirs[existing] == is_dir:
+                return existing, False
+            self.remove(existing)
+        entry_id = len(self.names)
+        self.parents.append(parent_id)
+        self.names.append(name)
+        self.dirs.append(1 if is_dir else 0)
+        self.alive.append(1)
+        siblings[name] = entry_id
+        if is_dir:
+            self.children[entry_id] = {}
+        for token in name_tokens(name):
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = array('I')
+                self.tokens_dirty = True
+            ids.append(entry_id)
+        self.live += 1
+        return entry_id, True
+
+    def remove(self, entry_id):
+        """Drop an entry and, for folders, everything below it"""
+        self.children[self.parents[entry_id]].pop(self.names[entry_id], None)
+        stack = [entry_id]
+        while stack:
+            current = stack.pop()
+            if not self.alive[current]:
+                continue
+            self.alive[current] = 0
+            self.live -= 1
+            below = self.children.pop(current, None)
+            if below:
+                stack.extend(below.values())
+
+    def scan(self, dir_id, path):
+        """Index everything under path (symlinked folders are listed, not entered)"""
+        stack = [(dir_id, path)]
+        while stack:
+            parent_id, folder = stack.pop()
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if is_internal_name(entry.name):
+                            continue
+                        try:
+                            is_dir = entry.is_dir()
+                            recurse = is_dir and not entry.is_symlink()
+                        except OSError:
+                            continue
+                        entry_id, created = self.add(parent_id, entry.name, is_dir)
+                        if recurse and created:
+                            stack.append((entry_id, entry.path))
+            except OSError:
+                continue  # unreadable folder
+
+    def lookup(self, parts):
+        """Id of the folder at the given path components, or None"""
+        current = 0
+        for part in parts:
+            current = self.children.get(current, {}).get(part)
+            if current is None or not self.dirs[current]:
+                return None
+        return current
+
+    def path_of(self, entry_id):
+        parts = []
+        while entry_id > 0:
+            parts.append(self.names[entry_id])
+            entry_id = self.parents[entry_id]
+        return "/" + "/".join(reversed(parts))
+
+    def matches(self, term, prefix=True):
+        """(ids whose token equals term, [ids of each token starting with term]), copied so they can be read unlocked"""
+        exact = self.postings.get(term, array('I'))[:]
+        if term.startswith(".") or not prefix:
+            return exact, [exact]
+        if self.tokens_dirty:
+            self.sorted_tokens = sorted(self.postings)
+            self.tokens_dirty = False
+        lo = bisect.bisect_left(self.sorted_tokens, term)
+        hi = bisect.bisect_left(self.sorted_tokens, term + "\U0010ffff")
+        return exact, [self.postings[token][:] for token in self.sorted_tokens[lo:hi]]
+
+    def rank(self, query, matched, limit):
+        """Score the matches() of each query term; returns (results, matches found).
+
+        Needs no lock: entries are only ever appended or flagged dead.
+        Collection stops at SEARCH_CANDIDATE_LIMIT, exact token matches of
+        the rarest term first.
+        """
+        if not matched:
+            return [], 0
+        matched.sort(key=lambda m: sum(len(ids) for ids in m[1]))
+        (driver_exact, driver_ids), rest = matched[0], matched[1:]
+        if not any(driver_ids):
+            return [], 0
+        rest = [(set(exact), set(itertools.chain.from_iterable(ids))) for exact, ids in rest]
+        alive = self.alive
+        candidates = {}  # id -> coarse score
+        for weight, ids in itertools.chain([(3, driver_exact)], ((1, ids) for ids in driver_ids)):
+            for i in ids:
+                if i in candidates or not alive[i]:
+                    continue
+                score = weight
+                for exact, prefixed in rest:
+                    if i not in prefixed:
+                        break
+                    score += 3 if i in exact else 1
+                else:
+                    candidates[i] = score
+                    if len(candidates) >= SEARCH_CANDIDATE_LIMIT:
+                        break
+            if len(candidates) >= SEARCH_CANDIDATE_LIMIT:
+                break
+
+        coarse = candidates.get
+        terms = search_terms(query)
+        whole = query.strip().lower()
+
+        def fine(i):
+            name = self.names[i].lower()
+            score = coarse(i) * 10
+            if name == whole or os.path.splitext(name)[0] == whole:
+                score += 50
+            elif name.startswith(terms[0]):
+                score += 20
+            depth = 0
+            parent = self.parents[i]
+            while parent > 0:
+                depth += 1
+                parent = self.parents[parent]
+            return (score - depth, -len(name))
+
+        shortlist = heapq.nlargest(limit * 4, candidates, key=coarse)
+        best = heapq.nlargest(limit, shortlist, key=fine)
+        return [(self.path_of(i), bool(self.dirs[i])) for i in best], len(candidates)
+
+class SearchIndex:
+    """Filename index over the shared tree, built in the background.
+
+    A full scan runs at startup and every SEARCH_RESCAN_INTERVAL seconds
+    into a fresh generation that is swapped in when complete. Uploads,
+    renames and deletes are applied straight away through update(), and
+    replayed onto a generation that was still scanning when they happened.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = NameIndexData()
+        self.root = None
+        self.ready = False
+        self.pending = None
+        self.build_seconds = 0.0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self, root, interval=SEARCH_RESCAN_INTERVAL):
+        self.stop()
+        self.root = os.path.abspath(root)
+        stop_event = self.stop_event = threading.Event()  # per run: a restart never revives the old thread
+
+        def run():
+            while True:
+                self.rebuild(stop_event)
+                if stop_event.wait(interval):
+                    break
+
+        self.thread = threading.Thread(target=run, name="search-index", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def rebuild(self, stop_event=None):
+        root = self.root
+        started = time.perf_counter()
+        with self.lock:
+            self.pending = []
+        fresh = NameIndexData()
+        fresh.scan(0, root)
+        with self.lock:
+            if root != self.root or (stop_event is not None and stop_event.is_set()):
+                return  # the share moved or the index was stopped while scanning
+            self.data = fresh
+            pending, self.pending = self.pending, None
+            for dir_path, name in pending:
+                self.apply(dir_path, name)
+            self.ready = True
+            self.build_seconds = time.perf_counter() - started
+
+    def update(self, dir_path, names):
+        """Re-check entries after the server changed them"""
+        if self.root is None:
+            return
+        with self.lock:
+            for name in names:
+                if self.pending is not None:
+                    self.pending.append((dir_path, name))
+                self.apply(dir_path, name)
+
+    def apply(self, dir_path, name):
+        rel = os.path.relpath(os.path.abspath(dir_path), self.root)
+        if rel.startswith(".."):
+            return
+        parts = [] if rel == "." else rel.split(os.sep)
+        data = self.data
+        dir_id = data.lookup(parts)
+        if dir_id is None:
+            return
+        full_path = os.path.join(dir_path, name)
+        if os.path.lexists(full_path):
+            is_dir = os.path.isdir(full_path)
+            entry_id, created = data.add(dir_id, name, is_dir)
+            if is_dir and created and not os.path.islink(full_path):
+                data.scan(entry_id, full_path)  # a folder moved or renamed in
+        else:
+            existing = data.children[dir_id].get(name)
+            if existing is not None:
+                data.remove(existing)
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        """Ranked (path, is_dir) matches for every term of query, and how many there are (capped).
+
+        Only the posting lookups happen under the lock; scoring runs
+        outside it, so uploads and renames are not held up by a broad query.
+        A query made only of one-character terms matches them as whole
+        tokens; next to longer terms they match as prefixes too.
+        """
+        terms = search_terms(query)
+        prefix = any(len(term) >= 2 for term in terms)
+        with self.lock:
+            data = self.data
+            matched = [data.matches(term, prefix) for term in terms]
+        return data.rank(query, matched, limit)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "ready": self.ready,
+                "entries": self.data.live,
+                "tokens": len(self.data.postings),
+                "build_seconds": round(self.build_seconds, 3),
+            }
+
+SEARCH_INDEX = SearchIndex()
+
+def stat_entry(path):
+    """Listing row for path as it is on disk now, or None if it is gone"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    is_dir = os.path.isdir(path)
+    return (is_dir, 0 if is_dir else st.st_size, st.st_mtime)
+
+def scan_folder(path):
+    """name -> listing row for one folder, or None if it cannot be read"""
+    entries = {}
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if is_internal_name(entry.name):
+                    continue
+                try:
+                    entries[entry.name] = scan_entry(entry)
+                except OSError:
+                    continue
+    except OSError:
+        return None
+    return entries
+
+class ChangeWatcher:
+    """Notices changes made behind the server's back in folders people are viewing.
+
+    Only folders with an open event stream are watched. Each change is
+    checked against the listing cache first, so the server's own uploads,
+    renames and deletes (already patched in) are not reported twice.
+
+    This class polls: it rescans each watched folder every interval and
+    diffs it against the last scan. InotifyWatcher replaces add, remove
+    and run where the OS can push changes instead.
+    """
+    def __init__(self, interval=WATCH_POLL_INTERVAL):
+        self.interval = interval
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        self.counts = {}  # folder -> open streams watching it
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="change-watcher", daemon=True)
+        self.thread.start()
+
+    def watch(self, dir_path):
+        with self.lock:
+            count = self.counts.get(dir_path, 0)
+            self.counts[dir_path] = count + 1
+            if count == 0:
+                self.add(dir_path)
+
+    def unwatch(self, dir_path):
+        with self.lock:
+            count = self.counts.get(dir_path, 0) - 1
+            if count > 0:
+                self.counts[dir_path] = count
+                return
+            self.counts.pop(dir_path, None)
+            self.remove(dir_path)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def report(self, dir_path, name):
+        if is_internal_name(name):
+            return
+        cached, row = LISTING_CACHE.peek(dir_path, name)
+        if cached and row == stat_entry(os.path.join(dir_path, name)):
+            return
+        entry_changed(dir_path, name)
+
+    def add(self, dir_path):
+        self.snapshots[dir_path] = scan_folder(dir_path) or {}
+
+    def remove(self, dir_path):
+        self.snapshots.pop(dir_path, None)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                folders = list(self.snapshots)
+            for dir_path in folders:
+                fresh = scan_folder(dir_path)
+                if fresh is None:
+                    continue
+                with self.lock:
+                    if dir_path not in self.snapshots:
+                        continue
+                    old, self.snapshots[dir_path] = self.snapshots[dir_path], fresh
+                for name in old.keys() | fresh.keys():
+                    if old.get(name) != fresh.get(name):
+                        self.report(dir_path, name)
+
+class InotifyWatcher(ChangeWatcher):
+    """Linux watcher on inotify(7), called through ctypes"""
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}  # watch descriptor -> folder
+        self.descriptors = {}  # folder -> watch descriptor
+        super().__init__()
+
+    def add(self, dir_path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), self.MASK | self.IN_ONLYDIR)
+        if wd >= 0:
+            self.folders[wd] = dir_path
+            self.descriptors[dir_path] = wd
+
+    def remove(self, dir_path):
+        wd = self.descriptors.pop(dir_path, None)
+        if wd is not None:
+            self.folders.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                if not select.select([self.fd], [], [], 1.0)[0]:
+                    continue
+                try:
+                    data = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+                    offset += self.EVENT_HEADER.size
+                    name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                    offset += length
+                    if mask & self.IN_Q_OVERFLOW:
+                        CHANGE_FEED.reset_all()
+                        continue
+                    with self.lock:
+                        dir_path = self.folders.get(wd)
+                        if mask & self.IN_IGNORED and dir_path is not None:
+                            self.folders.pop(wd, None)
+                            self.descriptors.pop(dir_path, None)
+                    if dir_path is not None and name:
+                        self.report(dir_path, name)
+        finally:
+            os.close(self.fd)
+
+def make_watcher():
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError):
+        return ChangeWatcher()
+
+class EventStream:
+    """One browser's subscription to a folder's change events"""
+    def __init__(self, dir_key):
+        self.dir_key = dir_key
+        self.events = deque()
+        self.overflowed = False
+
+class ChangeFeed:
+    """Fans change events out to the /api/events streams, one set per folder"""
+    def __init__(self, max_streams=MAX_EVENT_STREAMS):
+        self.max_streams = max_streams
+        self.cond = threading.Condition()
+        self.streams = {}  # listing key -> set of EventStream
+        self.count = 0
+        self.closed = True
+        self.watcher = None
+
+    def open(self):
+        with self.cond:
+            self.closed = False
+            if self.watcher is None:
+                self.watcher = make_watcher()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            watcher, self.watcher = self.watcher, None
+            self.cond.notify_all()
+        if watcher is not None:
+            watcher.stop()
+
+    def subscribe(self, dir_path):
+        """New stream for dir_path, or None when the server is at MAX_EVENT_STREAMS"""
+        key = LISTING_CACHE.key(dir_path)
+        with self.cond:
+            if self.closed or self.count >= self.max_streams:
+                return None
+            stream = EventStream(key)
+            self.streams.setdefault(key, set()).add(stream)
+            self.count += 1
+            watcher = self.watcher
+        watcher.watch(key)
+        return stream
+
+    def unsubscribe(self, stream):
+        with self.cond:
+            streams = self.streams.get(stream.dir_key)
+            if streams is None or stream not in streams:
+                return
+            streams.discard(stream)
+            if not streams:
+                del self.streams[stream.dir_key]
+            self.count -= 1
+            watcher = self.watcher
+        if watcher is not None:
+            watcher.unwatch(stream.dir_key)
+
+    def publish(self, dir_path, names):
+        key = LISTING_CACHE.key(dir_path)
+        if key not in self.streams:
+            return
+        events = []
+        for name in names:
+            row = stat_entry(os.path.join(dir_path, name))
+            entry = None
+            if row is not None:
+                is_dir, size, mtime = row
+                entry = {"name": name, "dir": is_dir, "size": size, "mtime": int(mtime)}
+            events.append({"name": name, "entry": entry})
+        with self.cond:
+            for stream in self.streams.get(key, ()):
+                if len(stream.events) + len(events) > EVENT_QUEUE_SIZE:
+                    stream.events.clear()
+                    stream.overflowed = True
+                elif not stream.overflowed:
+                    stream.events.extend(events)
+            self.cond.notify_all()
+
+    def reset_all(self):
+        """Tell every stream to reload, e.g. after the watcher lost events"""
+        with self.cond:
+            for streams in self.streams.values():
+                for stream in streams:
+                    stream.events.clear()
+                    stream.overflowed = True
+            self.cond.notify_all()
+
+    def wait(self, stream, timeout=EVENT_HEARTBEAT):
+        """(events, overflowed) once something happens or timeout passes; None once closed"""
+        with self.cond:
+            if not stream.events and not stream.overflowed and not self.closed:
+                self.cond.wait(timeout)
+            if self.closed:
+                return None
+            events = list(stream.events)
+            stream.events.clear()
+            overflowed, stream.overflowed = stream.overflowed, False
+            return events, overflowed
+
+CHANGE_FEED = ChangeFeed()
+
+def entry_changed(dir_path, *names):
+    """Tell the caches that entries of dir_path were created, modified or removed.
+
+    Pass every name a request touched in one call: the cached listing is
+    patched and re-versioned once, and viewers get the events together.
+    Sibling worker processes apply the same change through the bus.
+    """
+    names = [name for name in names if not is_internal_name(name)]
+    if names:
+        apply_entry_changes(dir_path, names)
+        BUS.send("changed", dir_path, names)
+
+def apply_entry_changes(dir_path, names):
+    LISTING_CACHE.update_entries(dir_path, names)
+    SEARCH_INDEX.update(dir_path, names)
+    HASH_INDEX.changed(dir_path, names)
+    CHANGE_FEED.publish(dir_path, names)
+
+def file_etag(fs, encoding=None):
+    """Strong validator for a file (or one encoding of it) built from its mtime and size"""
+    suffix = f"-{encoding}" if encoding else ""
+    return f'"{fs.st_mtime_ns:x}-{fs.st_size:x}{suffix}"'
+
+def is_compressible(ctype):
+    return ctype.startswith(COMPRESSIBLE_TYPES)
+
+def choose_encoding(accept_encoding):
+    """Pick br or gzip from an Accept-Encoding header, or None for identity"""
+    weights = {}
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().lower().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            weights[coding] = q
+    offered = (["br"] if brotli is not None else []) + ["gzip"]
+    best = None
+    for coding in offered:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (coding, q)
+    return best[0] if best else None
+
+def compress_bytes(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+def stream_compressor(encoding):
+    """(process, finish) functions of an incremental encoder at the compress_bytes levels"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip framing, mtime 0
+    return compressor.compress, compressor.flush
+
+class HotEntry:
+    """A cached response body and its headers; send_head returns it in place of an open file"""
+    def __init__(self, stamp, data, headers):
+        self.stamp = stamp
+        self.data = data  # bytes, or an mmap for mid-size files
+        self.headers = headers  # [(name, value)] sent after the status line
+
+    def close(self):
+        pass  # shared by every request that hits it
+
+def file_stamp(fs):
+    return fs.st_mtime_ns, fs.st_size, fs.st_ino
+
+class HotFileCache:
+    """Small, often requested files (favicons, thumbnails, documents) held in memory.
+
+    Entries keep the body and the precomputed 200 headers, are checked
+    against the file's mtime, size and inode on every hit, and the least
+    recently used ones go first once the byte budget is spent.
+    """
+    def __init__(self, budget=HOT_CACHE_BUDGET, max_file=HOT_CACHE_MAX_FILE, mmap_max=HOT_CACHE_MMAP_MAX):
+        self.budget = budget
+        self.max_file = max_file
+        self.mmap_max = mmap_max
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> HotEntry, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, fs):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.stamp == file_stamp(fs):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self.drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, fs, data, headers):
+        """Remember data for key if it fits the budget; returns the entry either way"""
+        entry = HotEntry(file_stamp(fs), data, headers)
+        if len(data) > self.budget:
+            return entry
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = entry
+            self.size += len(data)
+            while self.size > self.budget:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+        return entry
+
+    def load(self, key, f, fs, headers):
+        """Read (or map) open file f into the cache; None when it is too big to keep"""
+        size = os.fstat(f.fileno()).st_size
+        if not self.budget or size > max(self.max_file, self.mmap_max):
+            return None
+        if size > self.max_file:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = os.pread(f.fileno(), size, 0) if hasattr(os, "pread") else f.read(size)
+            if len(data) != size:
+                return None  # changed while being read
+        return self.put(key, fs, data, headers)
+
+    def drop(self, key):
+        # mapped bodies are unmapped by the garbage collector once no response is using them
+        self.size -= len(self.entries.pop(key).data)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+HOT_FILES = HotFileCache()
+
+class CompressionBuild:
+    """One compressed variant being made by the request that missed it"""
+    def __init__(self, cache, source, dest, encoding):
+        self.cache = cache
+        self.source = source
+        self.dest = dest
+        self.encoding = encoding
+        self.chunked = False  # set by the handler that streams it
+        self.done = False
+
+    def run(self, out):
+        """Compress the source into the cache file, passing every block to out as well.
+
+        A client that goes away does not stop the build, since other
+        requests may be waiting for the file; its error is raised at the end.
+        """
+        tmp = f"{self.dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+        error = None
+        try:
+            os.makedirs(os.path.dirname(self.dest), exist_ok=True)
+            process, finish = stream_compressor(self.encoding)
+            with open(self.source, "rb") as src, open(tmp, "wb") as f:
+                for block in itertools.chain(iter(lambda: src.read(COPY_BUFFER_SIZE), b""), [None]):
+                    data = process(block) if block is not None else finish()
+                    if not data:
+                        continue
+                    f.write(data)
+                    if error is None:
+                        try:
+                            out.write(data)
+                        except OSError as e:
+                            error = e
+            os.replace(tmp, self.dest)
+            self.cache.written()
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            self.close()
+        if error is not None:
+            raise error
+
+    def close(self):
+        if not self.done:
+            self.done = True
+            self.cache.finished(self.dest)
+
+class CompressedFileCache:
+    """Pre-compressed copies of text files, keyed by path, mtime and size.
+
+    A missing variant is built once, by the first request for it, which
+    streams the compressor output to its client while writing the cache
+    file; requests for it meanwhile wait for that file.
+    """
+    def __init__(self, cache_dir, limit=COMPRESS_CACHE_LIMIT):
+        self.cache_dir = cache_dir
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.building = {}  # cache file path -> Event set when its build ends
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, source, fs, encoding):
+        key = hashlib.sha1(f"{os.path.abspath(source)}|{fs.st_mtime_ns}|{fs.st_size}"
+                           .encode("utf-8", "surrogateescape")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{encoding}")
+
+    def get(self, source, fs, encoding, build=True, wait=CONNECTION_TIMEOUT):
+        """Path of the compressed variant, or a CompressionBuild the caller must run (or close).
+
+        None when build is false and the variant is missing, or when
+        another request's build of it is still going after wait seconds.
+        """
+        dest = self.path_for(source, fs, encoding)
+        deadline = time.monotonic() + wait
+        while True:
+            with self.lock:
+                if os.path.exists(dest):
+                    self.hits += 1
+                    return dest
+                event = self.building.get(dest)
+                if event is None:
+                    if not build:
+                        return None
+                    self.misses += 1
+                    self.building[dest] = threading.Event()
+                    return CompressionBuild(self, source, dest, encoding)
+            if not event.wait(max(0.0, deadline - time.monotonic())):
+                return None
+            # a failed build leaves no file behind; the next pass starts another
+
+    def finished(self, dest):
+        with self.lock:
+            self.building.pop(dest).set()
+
+    def written(self):
+        with self.lock:
+            self.writes += 1
+            prune = self.writes % 50 == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """Drop the least recently used variants once the cache passes its byte limit"""
+        files = []
+        for folder, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_atime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.limit:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+COMPRESSED_FILES = CompressedFileCache(os.path.join(CACHE_DIR, "compressed"))
+
+class BatchError(ValueError):
+    """One /api/batch operation was refused; the message goes back to the client"""
+
+def apply_batch_op(folder, op, resolve_dir):
+    """Apply one batch item inside folder; returns the (folder, name) pairs it changed.
+
+    Items look like {"op": "delete" | "mkdir", "name": ...},
+    {"op": "rename", "name": ..., "to": ...} or
+    {"op": "move", "name": ..., "dest": <folder URL>}. Nothing is overwritten.
+    """
+    if not isinstance(op, dict):
+        raise BatchError("Operation must be an object")
+    kind, name = op.get("op"), op.get("name")
+    if not is_plain_name(name):
+        raise BatchError("Bad name")
+    path = os.path.join(folder, name)
+    if kind == "mkdir":
+        os.mkdir(path)
+        return [(folder, name)]
+    if not os.path.lexists(path):
+        raise BatchError("Not found")
+
+    if kind == "delete":
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return [(folder, name)]
+
+    if kind == "rename":
+        dest, new_name = folder, op.get("to")
+        if not is_plain_name(new_name):
+            raise BatchError("Bad new name")
+    elif kind == "move":
+        if not isinstance(op.get("dest"), str) or not op["dest"]:
+            raise BatchError("Missing destination folder")
+        dest, new_name = resolve_dir(op["dest"]), name
+        if dest is None:
+            raise BatchError("No such destination folder")
+        real = os.path.realpath(path)
+        if os.path.isdir(path) and os.path.commonpath([real, os.path.realpath(dest)]) == real:
+            raise BatchError("Cannot move a folder into itself")
+    else:
+        raise BatchError("Unknown operation")
+    target = os.path.join(dest, new_name)
+    if os.path.lexists(target) and os.path.normcase(target) != os.path.normcase(path):
+        raise BatchError("Already exists")
+    shutil.move(path, target)
+    return [(folder, name), (dest, new_name)]
+
+class ChunkedWriter:
+    """Frames everything written through it as HTTP/1.1 chunked transfer coding"""
+    def __init__(self, raw):
+        self.raw = raw
+
+    def write(self, data):
+        if data:
+            self.raw.write(b"%x\r\n" % len(data))
+            self.raw.write(data)
+            self.raw.write(b"\r\n")
+        return len(data)
+
+    def close(self):
+        self.raw.write(b"0\r\n\r\n")
+
+class ZipSink:
+    """Write-only, unseekable target for zipfile that batches its small writes.
+
+    zipfile notices it cannot seek and writes each member's sizes in a
+    data descriptor after the data, so the archive streams straight out
+    with nothing held in memory beyond one buffer.
+    """
+    def __init__(self, out, buffer_size=ZIP_BUFFER_SIZE):
+        self.out = out
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.written = 0
+
+    def write(self, data):
+        if not self.buffer and len(data) >= self.buffer_size:
+            self.out.write(data)
+        else:
+            self.buffer += data
+            if len(self.buffer) < self.buffer_size:
+                return len(data)
+            self.out.write(self.buffer)
+            self.buffer.clear()
+        self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.out.write(self.buffer)
+            self.written += len(self.buffer)
+            self.buffer.clear()
+
+def zip_members(folder, names):
+    """(path, name in the archive) for the selected names, walking into folders.
+
+    Folder names end in "/". Internal files and symlinked folders are left
+    out, as are names that are not plain children of folder.
+    """
+    for name in dict.fromkeys(names):
+        if not is_plain_name(name):
+            continue
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            yield path, name
+            continue
+        if not os.path.isdir(path) or os.path.islink(path):
+            continue
+        yield path, name + "/"
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not is_internal_name(d)
+                                 and not os.path.islink(os.path.join(dirpath, d)))
+            prefix = os.path.relpath(dirpath, folder).replace(os.sep, "/") + "/"
+            for dirname in dirnames:
+                yield os.path.join(dirpath, dirname), prefix + dirname + "/"
+            for filename in sorted(filenames):
+                if not is_internal_name(filename):
+                    yield os.path.join(dirpath, filename), prefix + filename
+
+def write_zip(out, members):
+    """Stream a ZIP of members to out: text deflated, everything else stored"""
+    buf = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    with zipfile.ZipFile(out, "w", allowZip64=True, strict_timestamps=False) as archive:
+        for path, arcname in members:
+            try:
+                info = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+                if info.is_dir():
+                    archive.writestr(info, b"")
+                    continue
+                source = open(path, "rb")
+            except OSError:
+                continue  # vanished or unreadable since the walk listed it
+            ctype = mimetypes.guess_type(arcname)[0] or "application/octet-stream"
+            if is_compressible(ctype) and info.file_size >= MIN_COMPRESS_SIZE:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with source, archive.open(info, "w") as dest:
+                while True:
+                    n = source.readinto(buf)
+                    if not n:
+                        break
+                    dest.write(view[:n])
+
+def parse_range_header(value, size):
+    """Parse a bytes Range header into sorted, merged (start, end) pairs.
+
+    Returns None when the header should be ignored (bad syntax, other units,
+    too many ranges) and an empty list when no range can be satisfied.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        first, dash, last = (piece.strip() for piece in part.partition("-"))
+        if not dash or not (first or last) or not (first + last).isdigit():
+            return None
+        if not first:
+            # suffix range: the final N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(0, size - length), size - 1))
+            continue
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def cache_policy(ctype):
+    prefix = max((p for p in CACHE_POLICIES if ctype.startswith(p)), key=len, default="")
+    return CACHE_POLICIES.get(prefix, "no-cache")
+
+def etag_matches(header, etag):
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if header.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+def get_ip():
+    return socket.gethostbyname(socket.gethostname())
+
+def parse_cookies(header):
+    """Single pass over a Cookie header into a dict (first occurrence wins)"""
+    cookies = {}
+    for pair in (header or "").split(";"):
+        name, sep, value = pair.strip().partition("=")
+        if sep and name not in cookies:
+            cookies[name] = value.strip().strip('"')
+    return cookies
+
+class SessionStore:
+    """Login sessions with TTL checks on lookup, an LRU cap and a sweeper thread"""
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()  # token -> expiry, least recently used first
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.revoked = 0
+        self.sweeper = None
+        self.stop_event = threading.Event()
+
+    def create(self):
+        token = secrets.token_urlsafe(32)
+        self.adopt(token, time.time() + self.ttl)
+        with self.lock:
+            self.created += 1
+        return token
+
+    def adopt(self, token, expiry):
+        """Add a session created elsewhere, i.e. by a sibling worker process"""
+        with self.lock:
+            self.sessions[token] = expiry
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.evicted += 1
+
+    def expiry(self, token):
+        with self.lock:
+            return self.sessions.get(token)
+
+    def check(self, token):
+        """True for a live session; expired ones are dropped on sight"""
+        if not token:
+            return False
+        with self.lock:
+            expiry = self.sessions.get(token)
+            if expiry is None:
+                return False
+            if expiry <= time.time():
+                del self.sessions[token]
+                self.expired += 1
+                return False
+            self.sessions.move_to_end(token)
+            return True
 
-class TextRedirector:
-    def __init__(self, widget, tag="stdout"):
-        self.widget = widget
-        self.tag = tag
+    def revoke(self, token):
+        with self.lock:
+            if self.sessions.pop(token, None) is not None:
+                self.revoked += 1
 
-    def write(self, text):
-        self.widget.after(0, lambda: self.widget.insert(tk.END, text))
-        self.widget.after(0, lambda: self.widget.see(tk.END))
+    def clear(self):
+        with self.lock:
+            self.revoked += len(self.sessions)
+            self.sessions.clear()
 
-    def flush(self):
-        pass
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            stale = [token for token, expiry in self.sessions.items() if expiry <= now]
+            for token in stale:
+                del self.sessions[token]
+            self.expired += len(stale)
+        return len(stale)
 
-def get_ip():
-    return socket.gethostbyname(socket.gethostname())
+    def start_sweeper(self, interval=SESSION_SWEEP_INTERVAL):
+        if self.sweeper is not None and self.sweeper.is_alive():
+            return
+        self.stop_event.clear()
+
+        def run():
+            while not self.stop_event.wait(interval):
+                self.sweep()
+
+        self.sweeper = threading.Thread(target=run, name="session-sweeper", daemon=True)
+        self.sweeper.start()
+
+    def stop_sweeper(self):
+        self.stop_event.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "live": len(self.sessions),
+                "created": self.created,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "revoked": self.revoked,
+            }
+
+SESSIONS = SessionStore()
+
+class WorkerBus:
+    """A worker process's pipe to the master, which relays each message to the sibling workers.
+
+    Workers announce logins, logouts and entry_changed() calls on it, so
+    whichever worker answers a request sees the same sessions and fresh
+    listings. In a single-process server the bus is never attached and
+    send() does nothing.
+    """
+    def __init__(self):
+        self.conn = None
+        self.lock = threading.Lock()  # one message on the pipe at a time
+        self.handlers = {}
+        self.stopping = threading.Event()  # set on "stop" or when the master goes away
+
+    def on(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def attach(self, conn):
+        self.conn = conn
+        threading.Thread(target=self.run, name="worker-bus", daemon=True).start()
+
+    def send(self, kind, *args):
+        if self.conn is None:
+            return
+        try:
+            with self.lock:
+                self.conn.send((kind,) + args)
+        except (OSError, ValueError):
+            pass  # the master is gone and this worker is about to stop
+
+    def run(self):
+        while True:
+            try:
+                kind, *args = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            handler = self.handlers.get(kind)
+            try:
+                if handler is not None:
+                    handler(*args)
+            except Exception as e:
+                print(f"Bus message {kind!r} failed: {e}")
+        self.stopping.set()
 
-class ReusableTCPServer(socketserver.TCPServer):
+BUS = WorkerBus()
+
+class PooledTCPServer(socketserver.TCPServer):
+    """TCP server that hands each connection to a bounded pool of worker threads"""
     allow_reuse_address = True
 
-def start_server(path):
+    def __init__(self, server_address, handler, max_connections=MAX_CONNECTIONS, listen_socket=None):
+        self.max_connections = max_connections
+        self.active_connections = 0
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="fileshare")
+        self.stopping = False
+        if listen_socket is None:
+            super().__init__(server_address, handler)
+        else:  # bound and listening already, handed over by the master process
+            super().__init__(server_address, handler, bind_and_activate=False)
+            self.socket.close()
+            self.socket = listen_socket
+
+    def process_request(self, request, client_address):
+        with self._pending_lock:
+            if self._pending >= self.max_connections + MAX_PENDING_CONNECTIONS:
+                self.reject_request(request)
+                return
+            self._pending += 1
+        self._pool.submit(self.process_request_worker, request, client_address)
+
+    def process_request_worker(self, request, client_address):
+        with self._pending_lock:
+            self.active_connections += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._pending_lock:
+                self.active_connections -= 1
+                self._pending -= 1
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            return  # client went away or stalled past CONNECTION_TIMEOUT
+        super().handle_error(request, client_address)
+
+    def reject_request(self, request):
+        """Answer 503 straight from the accept loop when every worker and queue slot is taken"""
+        try:
+            request.sendall(b"HTTP/1.0 503 Service Unavailable\r\n"
+                            b"Retry-After: 2\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def keep_alive_ok(self):
+        """Whether a connection may stay open for another request: not while stopping or while others queue"""
+        return not self.stopping and self._pending <= self.max_connections
+
+    def shutdown(self):
+        self.stopping = True
+        super().shutdown()
+
+    def drain(self, timeout):
+        """Wait up to timeout seconds for accepted connections to finish; call after shutdown()"""
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
+
+def start_server(path, max_connections=MAX_CONNECTIONS, listen_socket=None, maintenance=True):
+    """Serve path on BIND_ADDRESS:PORT (or listen_socket) from a background thread; returns the server.
+
+    maintenance runs the share-wide background jobs (hashing, upload
+    sweeping); among worker processes only one does.
+    """
     global server_thread
     os.chdir(path)
+    SESSIONS.start_sweeper()
+    SEARCH_INDEX.start(path)
+    HASH_INDEX.start(path, sweep=maintenance)
+    if maintenance:
+        UPLOAD_SWEEPER.start(path)
+    CHANGE_FEED.open()
     handler = CustomHandler
-    httpd = ReusableTCPServer(("", PORT), handler)
+    httpd = PooledTCPServer((BIND_ADDRESS, PORT), handler, max_connections, listen_socket)
+    ACTIVE_CONNECTIONS.collect = lambda: httpd.active_connections
     server_thread = threading.Thread(target=httpd.serve_forever)
     server_thread.daemon = True
     server_thread.start()
     return httpd
 
 class CustomHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive: every response carries a Content-Length, is chunked or closes
+    disable_nagle_algorithm = True  # headers and body go out in separate writes; don't hold the body for an ACK
+    timeout = CONNECTION_TIMEOUT
+
+    def setup(self):
+        super().setup()
+        self.rfile = CountingReader(self.rfile)
+        self.wfile = CountingWriter(self.wfile)
+        self.requests_served = 0
+
+    def handle(self):
+        """Serve requests until the connection closes, idles out or reaches KEEPALIVE_MAX_REQUESTS"""
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        """Wait up to KEEPALIVE_TIMEOUT for the next request; False gives the worker up.
+
+        The socket is polled once a second so that an idle connection lets
+        go of its worker as soon as other connections queue for one.
+        """
+        self.connection.setblocking(False)  # peek() then returns b"" instead of blocking
+        try:
+            if self.rfile.peek(1):
+                return True  # already buffered
+            deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+            while self.server.keep_alive_ok():
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                if select.select([self.connection], [], [], min(1.0, left))[0]:
+                    return bool(self.rfile.peek(1))  # nothing readable means the client closed
+            return False
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def parse_request(self):
+        self.request_started = time.perf_counter()
+        self.status_code = None
+        self.sendfile_bytes = 0  # body bytes that bypassed wfile (sendfile and scheduled sends)
+        self.connection_header_sent = False
+        self.body_start = None
+        if not super().parse_request():
+            return False
+        self.body_start = self.rfile.consumed
+        return True
+
+    def body_unread(self):
+        """Whether the request body was not read to its end, so the next request cannot be found"""
+        if self.body_start is None:
+            return False
+        if "Transfer-Encoding" in self.headers:
+            return True  # request bodies are never chunk-decoded
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            return True
+        return self.rfile.consumed - self.body_start < length
+
+    def send_response_only(self, code, message=None):
+        self.status_code = code
+        super().send_response_only(code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == "connection":
+            self.connection_header_sent = True
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        """Tell the client whether the connection stays open after this response"""
+        if (self.status_code or 0) >= 200 and not getattr(self, "connection_header_sent", True):
+            if not self.close_connection and (self.requests_served + 1 >= KEEPALIVE_MAX_REQUESTS
+                                              or not self.server.keep_alive_ok() or self.body_unread()):
+                self.close_connection = True
+            if self.close_connection:
+                self.send_header("Connection", "close")
+            else:
+                self.send_header("Connection", "keep-alive")  # needed by HTTP/1.0 clients asking for it
+                self.send_header("Keep-Alive", f"timeout={KEEPALIVE_TIMEOUT}, "
+                                               f"max={KEEPALIVE_MAX_REQUESTS - self.requests_served - 1}")
+        super().end_headers()
+
+    def handle_one_request(self):
+        """Handle one request and record it in METRICS"""
+        self.request_started = None
+        written = self.wfile.written
+        super().handle_one_request()
+        if self.request_started is None:
+            return  # connection closed or timed out before a request arrived
+        self.requests_served += 1
+        if not self.close_connection and self.body_unread():
+            self.close_connection = True  # unread body bytes would be parsed as the next request
+        route = route_of(self.command, getattr(self, "path", ""))
+        REQUESTS_TOTAL.inc(route, str(self.status_code or 0))
+        REQUEST_SECONDS.observe(time.perf_counter() - self.request_started, route)
+        BYTES_SENT.inc(route, amount=self.wfile.written - written + self.sendfile_bytes)
+        try:
+            received = int(self.headers.get("Content-Length") or 0) if self.headers else 0
+        except ValueError:
+            received = 0
+        if received > 0:
+            BYTES_RECEIVED.inc(route, amount=received)
+
+    def transfer_slot(self, size):
+        """Take a transfer slot for a large body; returns whether one was taken"""
+        if size < LARGE_TRANSFER_SIZE:
+            return False
+        if not TRANSFER_SLOTS.acquire(timeout=TRANSFER_WAIT):
+            raise TimeoutError("no transfer slot available")
+        return True
+
+    def do_GET(self):
+        if self.is_upload_api():
+            self.handle_upload_api()
+            return
+        if urllib.parse.urlsplit(self.path).path == "/api/list":
+            self.handle_list_api()
+            return
+        if urllib.parse.urlsplit(self.path).path == "/api/search":
+            self.handle_search_api()
+            return
+        if urllib.parse.urlsplit(self.path).path == "/api/events":
+            self.handle_events()
+            return
+        if urllib.parse.urlsplit(self.path).path == "/download-zip":
+            self.handle_zip_download(urllib.parse.urlsplit(self.path).query)
+            return
+        if urllib.parse.urlsplit(self.path).path == "/metrics":
+            self.send_body(METRICS.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8",
+                           headers={"Cache-Control": "no-store"})
+            return
+        if self.path.startswith("/thumb/"):
+            self.handle_thumbnail()
+            return
+        if self.path.startswith(STATIC_PREFIX):
+            self.handle_static_asset()
+            return
+        path = self.translate_path(self.path)
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        try:
+            holds_slot = self.transfer_slot(size)
+        except TimeoutError:
+            self.send_busy()
+            return
+        try:
+            super().do_GET()
+        finally:
+            if holds_slot:
+                TRANSFER_SLOTS.release()
+
+    def send_body(self, data, ctype, status=200, headers=None):
+        """Send an in-memory response, compressed when the client accepts it"""
+        encoding = None
+        if len(data) >= MIN_COMPRESS_SIZE:
+            encoding = choose_encoding(self.headers.get("Accept-Encoding"))
+            if encoding:
+                data = compress_bytes(data, encoding)
+        self.send_response(status)
+        self.send_header("Content-type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def send_json(self, data, status=200, headers=None):
+        self.send_body(json.dumps(data).encode('utf-8'), "application/json; charset=utf-8", status, headers)
+
+    def is_not_modified(self, etag, mtime=None):
+        """Evaluate If-None-Match, or If-Modified-Since when there is no ETag check"""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag_matches(if_none_match, etag)
+        if mtime is None or "If-Modified-Since" not in self.headers:
+            return False
+        try:
+            ims = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"])
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        return ims.tzinfo is not None and int(mtime) <= ims.timestamp()
+
+    def send_not_modified(self, etag, cache_control, last_modified=None):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        if last_modified:
+            self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", cache_control)
+        self.end_headers()
+
+    def read_json(self):
+        """Parse a JSON request body; None (after replying 400) when it is invalid"""
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            data = json.loads(self.rfile.read(length) or b"{}")
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            data = None
+        if not isinstance(data, dict):
+            self.send_error(400, "Invalid JSON")
+            return None
+        return data
+
+    def is_internal_path(self, path):
+        """Whether a path from translate_path is, or lies inside, something the server keeps for itself"""
+        relative = os.path.relpath(path, self.directory)
+        return any(is_internal_name(part) for part in relative.split(os.sep))
+
+    def resolve_dir(self, url_path):
+        """Map a folder URL from the client onto a folder inside the shared root"""
+        if url_path is not None and not isinstance(url_path, str):
+            return None
+        path = self.translate_path(url_path or "/")
+        return path if os.path.isdir(path) and not self.is_internal_path(path) else None
+
+    def handle_upload_api(self):
+        """Resumable upload protocol: init, PUT chunks by offset, status, complete"""
+        parts = urllib.parse.urlsplit(self.path)
+        segments = parts.path.strip("/").split("/")[2:]
+
+        if self.command == "POST" and segments == ["init"]:
+            data = self.read_json()
+            if data is None:
+                return
+            name = safe_filename(data.get("name"))
+            target_dir = self.resolve_dir(data.get("dir"))
+            try:
+                size = int(data.get("size", -1))
+            except (TypeError, ValueError):
+                size = -1
+            if not name or is_internal_name(name) or target_dir is None or size < 0:
+                self.send_error(400, "Invalid upload request")
+                return
+            self.send_json(UPLOADS.create(name, size, target_dir))
+            return
+
+        if self.command == "POST" and segments == ["check"]:
+            self.handle_upload_check()
+            return
+
+        if not segments:
+            self.send_error(404, "Unknown upload")
+            return
+        upload_id = segments[0]
+        try:
+            if self.command == "GET" and len(segments) == 1:
+                self.send_json(UPLOADS.status(upload_id))
+            elif self.command == "PUT" and len(segments) == 1:
+                query = urllib.parse.parse_qs(parts.query)
+                offset = int(query.get("offset", ["0"])[0])
+                length = int(self.headers.get("Content-Length", 0))
+                UPLOADS.write_chunk(upload_id, offset, length, self.rfile)
+                self.send_json({"offset": offset, "length": length})
+            elif self.command == "POST" and segments[1:] == ["complete"]:
+                target = UPLOADS.complete(upload_id)
+                entry_changed(os.path.dirname(target), os.path.basename(target))
+                self.log_message('upload complete: %s', os.path.relpath(target, os.getcwd()))
+                self.send_json({"name": os.path.basename(target)})
+            elif self.command == "DELETE" and len(segments) == 1:
+                UPLOADS.meta(upload_id)
+                UPLOADS.discard(upload_id)
+                self.send_json({"discarded": upload_id})
+            else:
+                self.send_error(405, "Method not allowed")
+        except KeyError:
+            self.send_error(404, "Unknown upload")
+        except ValueError as e:
+            self.close_connection = True
+            self.send_error(400, str(e))
+
+    def handle_upload_check(self):
+        """POST /api/upload/check: place a file from content already in the share.
+
+        With just {size} the reply says whether hashing could pay off; with
+        {name, dir, size, sha256} a matching file is copied (or hard-linked)
+        into place on the server and nothing needs to be uploaded.
+        """
+        data = self.read_json()
+        if data is None:
+            return
+        try:
+            size = int(data.get("size", -1))
+        except (TypeError, ValueError):
+            size = -1
+        sha256 = str(data.get("sha256") or "").lower()
+        if not sha256:
+            self.send_json({"candidates": size >= 0 and HASH_INDEX.has_size(size)})
+            return
+        name = safe_filename(data.get("name"))
+        target_dir = self.resolve_dir(data.get("dir"))
+        if not name or is_internal_name(name) or target_dir is None or not re.fullmatch(r"[0-9a-f]{64}", sha256):
+            self.send_error(400, "Invalid upload request")
+            return
+        source = HASH_INDEX.find(sha256, size)
+        if source is None:
+            self.send_json({"exists": False})
+            return
+
+        target = os.path.join(target_dir, name)
+        if os.path.normcase(os.path.abspath(source)) != os.path.normcase(os.path.abspath(target)):
+            temp = partial_upload_path(target_dir)
+            try:
+                if DEDUP_HARDLINK:
+                    try:
+                        os.link(source, temp)
+                    except OSError:
+                        shutil.copyfile(source, temp)  # another volume, or links unsupported
+                else:
+                    shutil.copyfile(source, temp)
+                os.replace(temp, target)
+            except OSError as e:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                self.send_error(500, "Could not place file: %s" % e)
+                return
+            HASH_INDEX.record(target, sha256)
+            entry_changed(target_dir, name)
+        self.log_message('deduplicated upload: %s from %s', name, os.path.relpath(source, os.getcwd()))
+        self.send_json({"exists": True, "name": name})
+
+    def is_upload_api(self):
+        return self.path.startswith("/api/upload/")
+
+    def do_PUT(self):
+        if self.is_upload_api():
+            self.handle_upload_api()
+        else:
+            self.send_error(405, "Method not allowed")
+
+    do_DELETE = do_PUT
+
+    def send_head(self):
+        """Serve regular files with Range support; directories use the stock handler"""
+        self.range_parts = None
+        path = self.translate_path(self.path)
+        if self.is_internal_path(path):
+            self.send_error(404, "File not found")
+            return None
+        if os.path.isdir(path) or path.endswith("/"):
+            return super().send_head()
+        try:
+            fs = os.stat(path)
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+        ctype = self.guess_type(path)
+        compressible = is_compressible(ctype) and MIN_COMPRESS_SIZE <= fs.st_size <= MAX_COMPRESS_FILE
+        settled = time.time() - fs.st_mtime >= COMPRESS_SETTLE_TIME
+        encoding = None
+        if compressible and settled and "Range" not in self.headers:
+            encoding = choose_encoding(self.headers.get("Accept-Encoding"))
+        etag = file_etag(fs, encoding)
+        last_modified = self.date_time_string(fs.st_mtime)
+        cache_control = cache_policy(ctype)
+        if self.is_not_modified(etag, fs.st_mtime):
+            # answered from the stat alone, the file is never opened
+            self.send_not_modified(etag, cache_control, last_modified)
+            return None
+        if "Range" not in self.headers:
+            entry = HOT_FILES.get((path, encoding), fs)
+            if entry is not None:
+                self.send_headers(200, entry.headers)
+                return entry
+        if encoding:
+            f = self.open_compressed(path, fs, encoding)
+            if isinstance(f, CompressionBuild):
+                headers = [("Content-type", ctype), ("Content-Encoding", encoding), ("Vary", "Accept-Encoding"),
+                           ("ETag", etag), ("Last-Modified", last_modified), ("Cache-Control", cache_control)]
+                f.chunked = self.request_version == "HTTP/1.1"
+                if f.chunked:
+                    headers.append(("Transfer-Encoding", "chunked"))
+                else:
+                    self.close_connection = True  # length unknown until compressed: the close ends the body
+                try:
+                    self.send_headers(200, headers)
+                except:
+                    f.close()
+                    raise
+                return f
+            if f is not None:
+                variant = os.fstat(f.fileno())
+                headers = [("Content-type", ctype), ("Content-Length", str(variant.st_size)),
+                           ("Content-Encoding", encoding), ("Vary", "Accept-Encoding"), ("ETag", etag),
+                           ("Last-Modified", last_modified), ("Cache-Control", cache_control)]
+                entry = HOT_FILES.load((path, encoding), f, fs, headers)
+                if entry is not None:
+                    f.close()
+                    f = entry
+                self.send_headers(200, headers)
+                return f
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+
+        try:
+            fs = os.fstat(f.fileno())
+            etag = file_etag(fs)
+            last_modified = self.date_time_string(fs.st_mtime)
+            ranges = None
+            if "Range" in self.headers and self.if_range_matches(etag, last_modified):
+                ranges = parse_range_header(self.headers["Range"], fs.st_size)
+
+            if ranges == []:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{fs.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                f.close()
+                return None
+
+            common = [("Accept-Ranges", "bytes"), ("ETag", etag), ("Last-Modified", last_modified),
+                      ("Cache-Control", cache_control)]
+            if compressible:
+                common.append(("Vary", "Accept-Encoding"))
+            if ranges is None:
+                headers = [("Content-type", ctype), ("Content-Length", str(fs.st_size))] + common
+                entry = HOT_FILES.load((path, None), f, fs, headers)
+                if entry is not None:
+                    f.close()
+                    f = entry
+                self.send_headers(200, headers)
+                return f
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                self.range_parts = [(start, end - start + 1, b"")]
+                self.send_headers(206, [("Content-type", ctype),
+                                        ("Content-Range", f"bytes {start}-{end}/{fs.st_size}"),
+                                        ("Content-Length", str(end - start + 1))] + common)
+            else:
+                boundary = secrets.token_hex(12)
+                self.range_parts = []
+                length = 0
+                for start, end in ranges:
+                    part_head = (f"\r\n--{boundary}\r\nContent-Type: {ctype}\r\n"
+                                 f"Content-Range: bytes {start}-{end}/{fs.st_size}\r\n\r\n").encode()
+                    self.range_parts.append((start, end - start + 1, part_head))
+                    length += len(part_head) + end - start + 1
+                self.range_trailer = f"\r\n--{boundary}--\r\n".encode()
+                length += len(self.range_trailer)
+                self.send_headers(206, [("Content-type", f"multipart/byteranges; boundary={boundary}"),
+                                        ("Content-Length", str(length))] + common)
+            return f
+        except:
+            f.close()
+            raise
+
+    def send_headers(self, code, headers):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+
+    def open_compressed(self, path, fs, encoding):
+        """Open the cached compressed variant of a file, or a CompressionBuild to stream; None falls back to identity"""
+        try:
+            variant = COMPRESSED_FILES.get(path, fs, encoding, build=self.command != "HEAD")
+            return open(variant, "rb") if isinstance(variant, str) else variant
+        except OSError as e:
+            self.log_message("compression skipped for %s: %s", path, e)
+            return None
+
+    def if_range_matches(self, etag, last_modified):
+        """Validate If-Range; a stale validator means the whole file is sent instead"""
+        if_range = self.headers.get("If-Range")
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(('"', 'W/')):
+            return if_range == etag  # weak validators never match
+        return if_range == last_modified
+
+    def copyfile(self, source, outputfile):
+        if isinstance(source, HotEntry):
+            FIRST_BYTE_SECONDS.observe(time.perf_counter() - self.request_started, "file")
+            outputfile.write(source.data)
+            return
+        if isinstance(source, CompressionBuild):
+            FIRST_BYTE_SECONDS.observe(time.perf_counter() - self.request_started, "file")
+            out = ChunkedWriter(outputfile) if source.chunked else outputfile
+            source.run(out)
+            if source.chunked:
+                out.close()
+            return
+        try:
+            parts = self.range_parts or [(0, os.fstat(source.fileno()).st_size, b"")]
+        except (AttributeError, OSError, ValueError):
+            return super().copyfile(source, outputfile)
+
+        method = "sendfile" if hasattr(os, "sendfile") else "copy"
+        started = time.perf_counter()
+        FIRST_BYTE_SECONDS.observe(started - self.request_started, "file")
+        sent = 0
+        for start, length, part_head in parts:
+            if part_head:
+                outputfile.write(part_head)
+            sent += self.send_file_range(source, start, length)
+        if len(parts) > 1:
+            outputfile.write(self.range_trailer)
+
+        elapsed = time.perf_counter() - started
+        TRANSFER_STATS.record(method, self.client_address[0], sent, elapsed)
+        if sent >= LARGE_TRANSFER_SIZE:
+            self.log_message('sent %.1f MB in %.2fs (%.1f MB/s via %s)',
+                             sent / 1e6, elapsed, sent / 1e6 / max(elapsed, 1e-6), method)
+
+    def send_file_range(self, source, offset, length):
+        """Send length bytes of source starting at offset; returns bytes sent.
+
+        Large bodies go out in steps of at most SCHED_QUANTUM, each granted by SCHEDULER.
+        """
+        client = self.client_address[0] if length >= LARGE_TRANSFER_SIZE else None
+        sent = 0
+        if hasattr(os, "sendfile"):
+            while sent < length:
+                if client:
+                    count = self.scheduled_send(client, min(SCHED_QUANTUM, length - sent), lambda n: os.sendfile(
+                        self.connection.fileno(), source.fileno(), offset + sent, n))
+                else:
+                    # socket.sendfile copes with the socket timeout that raw os.sendfile does not
+                    count = self.connection.sendfile(source, offset + sent, min(SENDFILE_CHUNK, length - sent))
+                    self.sendfile_bytes += count
+                if not count:
+                    break
+                sent += count
+            return sent
+
+        source.seek(offset)
+        out = ScheduledWriter(self, client) if client else self.wfile
+        buf = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buf)
+        while sent < length:
+            n = source.readinto(view[:min(COPY_BUFFER_SIZE, length - sent)])
+            if not n:
+                break
+            out.write(view[:n])
+            sent += n
+        return sent
+
+    def scheduled_send(self, client, count, send):
+        """Send up to count bytes with send(count) under one SCHEDULER grant; returns the bytes sent.
+
+        The grant is only asked for once the socket is writable, and send
+        must not block (the socket has a timeout, so its descriptor is
+        non-blocking): a client that stops reading waits here, not in a slot.
+        """
+        while True:
+            if not select.select([], [self.connection], [], self.timeout)[1]:
+                raise TimeoutError("client stopped reading")
+            SCHEDULER.acquire(client, count)
+            sent = 0
+            try:
+                sent = send(count)
+            except BlockingIOError:
+                continue
+            finally:
+                SCHEDULER.release(client, count - sent)
+            self.sendfile_bytes += sent
+            return sent
+
+    def send_busy(self):
+        self.send_response(503)
+        self.send_header("Retry-After", "5")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def session_token(self):
+        return parse_cookies(self.headers.get('Cookie')).get('session_token')
+
     def authenticate(self):
         """Check if user is authenticated via session token"""
-        cookie = self.headers.get('Cookie', '')
-        cookies = {}
-        for c in cookie.split(';'):
-            parts = c.strip().split('=')
-            if len(parts) == 2:
-                cookies[parts[0]] = parts[1]
-                
-        token = cookies.get('session_token')
-        return token and token in SESSION_TOKENS
+        return SESSIONS.check(self.session_token())
 
     def log_message(self, format, *args):
         print(self.address_string(), "-", self.log_date_time_string(), "-", format % args)
 
     def do_POST(self):
+        if self.is_upload_api():
+            self.handle_upload_api()
+            return
+
+        if self.path == "/api/batch":
+            self.handle_batch()
+            return
+
+        if self.path == "/download-zip":
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > MAX_ZIP_REQUEST:
+                self.send_error(413, "Selection too large")
+                return
+            self.handle_zip_download(self.rfile.read(length).decode('utf-8', 'replace'))
+            return
+
         # Handle login requests
         if self.path == "/login":
             content_length = int(self.headers['Content-Length'])
@@ -80,192 +3192,456 @@ class CustomHandler(http.server.SimpleHTTPRequestHandler):
             password = data.get('password', '')
             
             if username == AUTH_USERNAME and password == AUTH_PASSWORD:
-                # Generate session token
-                token = secrets.token_urlsafe(32)
-                SESSION_TOKENS[token] = time.time() + 3600  # 1 hour expiration
-                
-                self.send_response(200)
-                self.send_header('Set-Cookie', f'session_token={token}; Path=/; HttpOnly')
-                self.end_headers()
-                self.wfile.write(b'OK')
+                token = SESSIONS.create()
+                BUS.send("session", token, SESSIONS.expiry(token))
+                self.send_body(b'OK', "text/plain; charset=utf-8", headers={
+                    'Set-Cookie': f'session_token={token}; Path=/; Max-Age={SESSIONS.ttl}; HttpOnly; SameSite=Lax'})
             else:
-                self.send_response(401)
-                self.end_headers()
-                self.wfile.write(b'Invalid credentials')
+                self.send_body(b'Invalid credentials', "text/plain; charset=utf-8", 401)
             return
         
         # Handle logout
         if self.path == "/logout":
-            token = self.headers.get('Cookie', '').split('session_token=')[-1].split(';')[0]
-            if token in SESSION_TOKENS:
-                del SESSION_TOKENS[token]
-            self.send_response(200)
-            self.send_header('Set-Cookie', 'session_token=; Path=/; Expires=Thu, 01 Jan 1970 00:00:00 GMT')
-            self.end_headers()
-            self.wfile.write(b'Logged out')
+            token = self.session_token()
+            SESSIONS.revoke(token)
+            if token:
+                BUS.send("logout", token)
+            self.send_body(b'Logged out', "text/plain; charset=utf-8", headers={
+                'Set-Cookie': 'session_token=; Path=/; Expires=Thu, 01 Jan 1970 00:00:00 GMT'})
             return
         
         # Protected operations
         if self.path in ["/delete", "/rename"]:
             if not self.authenticate():
-                self.send_response(401)
-                self.end_headers()
-                self.wfile.write(b'Authentication required')
+                self.send_body(b'Authentication required', "text/plain; charset=utf-8", 401)
                 return
         
         # Original file operations
         if self.path == "/delete":
-            length = int(self.headers.get("Content-Length", 0))
-            data = json.loads(self.rfile.read(length))
-            filename = data.get("filename")
-            filepath = os.path.join(os.getcwd(), os.path.basename(filename))
-            if os.path.exists(filepath):
-                os.remove(filepath)
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"Deleted")
-            else:
+            data = self.read_json()
+            if data is None:
+                return
+            filename = plain_basename(data.get("filename"))
+            if filename is None:
+                self.send_error(400, "Bad file name")
+                return
+            target_dir = self.resolve_dir(data.get("dir"))
+            filepath = os.path.join(target_dir or "", filename)
+            if not target_dir or not os.path.lexists(filepath):
                 self.send_error(404, "File not found")
+                return
+            if os.path.isdir(filepath) and not os.path.islink(filepath):
+                self.send_error(409, "Is a folder")
+                return
+            try:
+                os.remove(filepath)
+            except OSError as e:
+                self.send_error(409, e.strerror or "Cannot delete")
+                return
+            entry_changed(target_dir, filename)
+            self.send_body(b"Deleted", "text/plain; charset=utf-8")
             return
 
         if self.path == "/rename":
-            length = int(self.headers.get("Content-Length", 0))
-            data = json.loads(self.rfile.read(length))
-            old = os.path.basename(data.get("oldName"))
-            new = os.path.basename(data.get("newName"))
-            if not old or not new:
-                self.send_error(400, "Missing name(s)")
+            data = self.read_json()
+            if data is None:
                 return
-            old_path = os.path.join(os.getcwd(), old)
-            new_path = os.path.join(os.getcwd(), new)
-            if os.path.exists(old_path):
-                os.rename(old_path, new_path)
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"Renamed")
-            else:
+            old = plain_basename(data.get("oldName"))
+            new = plain_basename(data.get("newName"))
+            if old is None or new is None:
+                self.send_error(400, "Missing or bad name(s)")
+                return
+            target_dir = self.resolve_dir(data.get("dir"))
+            old_path = os.path.join(target_dir or "", old)
+            new_path = os.path.join(target_dir or "", new)
+            if not target_dir or not os.path.lexists(old_path):
                 self.send_error(404, "File not found")
+                return
+            if os.path.lexists(new_path) and os.path.normcase(new_path) != os.path.normcase(old_path):
+                self.send_error(409, "Already exists")
+                return
+            try:
+                os.rename(old_path, new_path)
+            except OSError as e:
+                self.send_error(409, e.strerror or "Cannot rename")
+                return
+            entry_changed(target_dir, old, new)
+            self.send_body(b"Renamed", "text/plain; charset=utf-8")
             return
 
         # File upload handling
+        try:
+            holds_slot = self.transfer_slot(int(self.headers.get("Content-Length", 0)))
+        except TimeoutError:
+            self.close_connection = True
+            self.send_busy()
+            return
+        try:
+            self.handle_upload()
+        finally:
+            if holds_slot:
+                TRANSFER_SLOTS.release()
+
+    def upload_dir(self):
+        """Folder an upload posted to self.path should land in; None for the server's own folders"""
+        path = self.translate_path(self.path)
+        if self.is_internal_path(path):
+            return None
+        return path if os.path.isdir(path) else os.getcwd()
+
+    def handle_upload(self):
         content_type = self.headers.get("Content-Type", "")
         if not content_type.startswith("multipart/form-data"):
             self.send_error(400, "Bad Request: Expected multipart/form-data")
             return
 
-        boundary = content_type.split("boundary=")[-1].encode()
-        remainbytes = int(self.headers['Content-length'])
-        line = self.rfile.readline()
-        remainbytes -= len(line)
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not match:
+            self.send_error(400, "Missing multipart boundary")
+            return
+        reader = MultipartReader(self.rfile, match.group(1).encode(),
+                                 int(self.headers.get("Content-Length", 0)))
+        target_dir = self.upload_dir()
+        if target_dir is None:
+            self.send_error(404, "No such folder")
+            return
+        saved = []
+        try:
+            for headers in reader:
+                field, filename = parse_disposition(headers.get("content-disposition", ""))
+                if filename is None:
+                    reader.read_value()
+                    continue
+                filename = safe_filename(filename)
+                if not filename or is_internal_name(filename):
+                    continue
+                filepath = os.path.join(target_dir, filename)
+                HASH_INDEX.record(filepath, self.receive_file(reader, filepath))
+                entry_changed(target_dir, filename)
+                saved.append(filename)
+        except (MultipartError, ConnectionError, TimeoutError) as e:
+            self.close_connection = True
+            if isinstance(e, MultipartError):
+                self.send_error(400, str(e))
+            return
 
-        if boundary not in line:
-            self.send_error(400, "Content does not begin with boundary")
+        if not saved:
+            self.send_error(400, "No file uploaded")
             return
 
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        filename = None
-        while line and line.strip():
-            if b'Content-Disposition' in line and b'filename="' in line:
-                filename = line.decode().split('filename="')[-1].split('"')[0]
-            line = self.rfile.readline()
-            remainbytes -= len(line)
+        self.send_body(b"OK", "text/plain; charset=utf-8")
 
-        if not filename:
-            self.send_error(400, "No file uploaded")
+    def receive_file(self, reader, filepath):
+        """Write the current multipart body to filepath; returns its SHA-256.
+
+        The data goes to a preallocated hidden temp file in the same folder,
+        is flushed to disk and then renamed over filepath in one step, so
+        listings and downloads never see a half-written file.
+        """
+        temp = partial_upload_path(os.path.dirname(filepath))
+        digest = hashlib.sha256()
+        try:
+            with open(temp, "wb", buffering=UPLOAD_WRITE_BUFFER) as out:
+                preallocate(out, reader.remaining + len(reader.buffer))
+
+                def write(data):
+                    digest.update(data)
+                    out.write(data)
+
+                reader.read_into(write)
+                out.truncate()  # drop whatever was preallocated beyond the data
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(temp, filepath)
+        except BaseException:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+        return digest.hexdigest()
+
+    def handle_list_api(self):
+        """GET /api/list: one page of a folder, sorted and optionally prefix-filtered"""
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+
+        def arg(name, default=""):
+            return query.get(name, [default])[0]
+
+        path = self.resolve_dir(arg("path", "/"))
+        try:
+            listing = LISTING_CACHE.get(path) if path else None
+            offset = max(0, int(arg("offset", "0")))
+            limit = min(LIST_PAGE_LIMIT, max(1, int(arg("limit", str(LIST_PAGE_SIZE)))))
+        except OSError:
+            listing = None
+        except ValueError:
+            self.send_error(400, "Bad offset or limit")
+            return
+        if listing is None:
+            self.send_error(404, "No such folder")
             return
 
-        filename = re.sub(r'[\\/*?:"<>|]', "_", os.path.basename(filename))
-        filepath = os.path.join(os.getcwd(), filename)
-        with open(filepath, 'wb') as out:
-            preline = self.rfile.readline()
-            remainbytes -= len(preline)
-            while remainbytes > 0:
-                line = self.rfile.readline()
-                remainbytes -= len(line)
-                if boundary in line:
-                    out.write(preline.rstrip(b'\r\n'))
-                    break
-                else:
-                    out.write(preline)
-                    preline = line
+        is_authenticated = bool(self.authenticate())
+        etag = f'W/"l{INSTANCE_ID}-{listing.mtime_ns:x}-{listing.version}-{int(is_authenticated)}"'
+        if self.is_not_modified(etag):
+            self.send_not_modified(etag, LISTING_CACHE_POLICY)
+            return
 
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"OK")
+        sort = arg("sort", "name")
+        if sort not in ("name", "size", "mtime"):
+            sort = "name"
+        descending = arg("order") == "desc"
+        names = sorted_listing(listing, sort, descending)
+        if arg("prefix"):
+            names = filter_prefix(listing, names, sort, descending, arg("prefix"))
 
-    def list_directory(self, path):
+        entries = []
+        page = names[offset:offset + limit]
+        for name in page:
+            is_dir, size, mtime = listing.entries[name]
+            entries.append({"name": name, "dir": is_dir, "size": size, "mtime": int(mtime)})
+        THUMBNAILS.prefetch(path, [name for name in page if not listing.entries[name][0]])
+        self.send_json({
+            "total": len(names),
+            "offset": offset,
+            "version": listing.version,
+            "authenticated": is_authenticated,
+            "thumbnails": [kind for kind, ok in (("image", Image), ("video", FFMPEG)) if ok],
+            "entries": entries,
+        }, headers={"ETag": etag, "Cache-Control": LISTING_CACHE_POLICY})
+
+    def handle_search_api(self):
+        """GET /api/search?q=: ranked paths whose names match every query term"""
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        text = query.get("q", [""])[0][:200]
         try:
-            file_list = os.listdir(path)
-        except os.error:
-            self.send_error(404, "No permission to list directory")
-            return None
+            limit = min(SEARCH_RESULT_LIMIT, max(1, int(query.get("limit", ["50"])[0])))
+        except ValueError:
+            limit = 50
+        started = time.perf_counter()
+        results, total = SEARCH_INDEX.search(text, limit)
+        self.send_json({
+            "query": text,
+            "total": total,
+            "capped": total >= SEARCH_CANDIDATE_LIMIT,
+            "ready": SEARCH_INDEX.ready,
+            "ms": round((time.perf_counter() - started) * 1000, 2),
+            "results": [{"path": path, "dir": is_dir} for path, is_dir in results],
+        }, headers={"Cache-Control": "no-store"})
+
+    def handle_batch(self):
+        """POST /api/batch: apply a list of file operations with one result per item"""
+        if not self.authenticate():
+            self.send_json({"error": "Authentication required"}, 401)
+            return
+        data = self.read_json()
+        if data is None:
+            return
+        ops = data.get("ops")
+        folder = self.resolve_dir(data.get("dir"))
+        if not isinstance(ops, list) or len(ops) > MAX_BATCH_OPS:
+            self.send_error(400, "ops must be a list of at most %d operations" % MAX_BATCH_OPS)
+            return
+        if folder is None:
+            self.send_error(404, "No such folder")
+            return
+
+        results = []
+        changed = {}  # folder -> names, so each folder is refreshed once
+        for op in ops:
+            try:
+                for dir_path, name in apply_batch_op(folder, op, self.resolve_dir):
+                    changed.setdefault(dir_path, {})[name] = None
+                results.append({"ok": True})
+            except BatchError as e:
+                results.append({"ok": False, "error": str(e)})
+            except OSError as e:
+                results.append({"ok": False, "error": e.strerror or str(e)})
+            except Exception as e:
+                # keep going: the items already applied still need their cache and feed updates
+                self.log_error("batch item %r failed: %r", op, e)
+                results.append({"ok": False, "error": "Internal error"})
+        for dir_path, names in changed.items():
+            entry_changed(dir_path, *names)
+        done = sum(result["ok"] for result in results)
+        self.send_json({"results": results, "done": done, "failed": len(results) - done})
 
-        file_list.sort(key=lambda a: a.lower())
-        rel_path = os.path.relpath(path, os.getcwd())
-        is_ajax = self.headers.get('X-Requested-With') == 'XMLHttpRequest'
-        is_authenticated = self.authenticate()
+    def handle_zip_download(self, form):
+        """/download-zip?dir=&name=...: stream the selected files and folders as one ZIP.
 
-        # Generate auth button HTML
-        if is_authenticated:
-            auth_button = '<button onclick="logout()" style="position:absolute;top:10px;right:100px;">Logout</button>'
+        With no name fields the whole folder is zipped. Uses chunked transfer
+        coding on HTTP/1.1 connections and plain close-delimited bodies otherwise.
+        """
+        fields = urllib.parse.parse_qs(form)
+        folder = self.resolve_dir(fields.get("dir", ["/"])[0])
+        if folder is None:
+            self.send_error(404, "No such folder")
+            return
+        try:
+            names = fields.get("name") or sorted(os.listdir(folder))
+        except OSError:
+            names = []
+        members = zip_members(folder, names)
+        first = next(members, None)
+        if first is None:
+            self.send_error(404, "Nothing to download")
+            return
+        if len(names) == 1:
+            archive_name = names[0]
         else:
-            auth_button = '<button onclick="showLoginModal()" style="position:absolute;top:10px;right:100px;">Login</button>'
-
-        rows = []
-        for name in file_list:
-            full_path = os.path.join(path, name)
-            displayname = name + "/" if os.path.isdir(full_path) else name
-            linkname = name + "/" if os.path.isdir(full_path) else name
-            stat = os.stat(full_path)
-            size = "-" if os.path.isdir(full_path) else f"{stat.st_size / (1024*1024):.2f} MB"
-            preview_html = ""
-
-            if name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp')):
-                preview_html = f'<img src="{linkname}">'
-            elif name.lower().endswith(('.mp3', '.wav', '.ogg')):
-                preview_html = f'<audio controls src="{linkname}"></audio>'
-            elif name.lower().endswith(('.mp4', '.webm', '.ogg')):
-                preview_html = f'<video controls src="{linkname}"></video>'
-                
-            # Only show action buttons if authenticated
-            action_buttons = ""
-            if is_authenticated:
-                action_buttons = (
-                    f'<td><button onclick="deleteFile(\'{linkname}\')">🗑 Delete</button> '
-                    f'<button onclick="renameFile(\'{linkname}\')">✏ Rename</button></td>'
-                )
+            archive_name = os.path.basename(os.path.normpath(folder)) or "files"
+
+        try:
+            holds_slot = self.transfer_slot(LARGE_TRANSFER_SIZE)
+        except TimeoutError:
+            self.send_busy()
+            return
+        chunked = self.request_version == "HTTP/1.1" and self.protocol_version == "HTTP/1.1"
+        started = time.perf_counter()
+        sink = None
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Disposition", "attachment; filename*=UTF-8''%s"
+                             % urllib.parse.quote(archive_name + ".zip"))
+            self.send_header("Cache-Control", "no-store")
+            self.send_header("X-Accel-Buffering", "no")  # let a proxy pass it through as it is made
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
             else:
-                action_buttons = '<td>Login required</td>'
-
-            rows.append(
-                f'<tr><td><a href="{linkname}">{displayname}</a></td>'
-                f'<td>{size}</td><td>{preview_html}</td>'
-                f'{action_buttons}</tr>'
-            )
-
-        if is_ajax:
-            # Return JSON with both file list and auth button
-            response_data = {
-                "table": "\n".join(rows),
-                "authButton": auth_button
-            }
-            encoded = json.dumps(response_data).encode('utf-8', 'surrogateescape')
+                self.close_connection = True
+            self.end_headers()
+            FIRST_BYTE_SECONDS.observe(time.perf_counter() - self.request_started, "zip")
+            out = ScheduledWriter(self, self.client_address[0])
+            if chunked:
+                out = ChunkedWriter(out)
+            sink = ZipSink(out)
+            write_zip(sink, itertools.chain([first], members))
+            sink.flush()
+            if chunked:
+                out.close()
+        except ConnectionError:
+            self.close_connection = True
+            return  # download cancelled
+        finally:
+            if holds_slot:
+                TRANSFER_SLOTS.release()
+            if sink is not None:
+                elapsed = time.perf_counter() - started
+                TRANSFER_STATS.record("zip", self.client_address[0], sink.written, elapsed)
+                self.log_message('zipped %.1f MB in %.2fs (%.1f MB/s)',
+                                 sink.written / 1e6, elapsed, sink.written / 1e6 / max(elapsed, 1e-6))
+
+    def handle_events(self):
+        """GET /api/events?path=: server-sent events for changes in one folder"""
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        path = self.resolve_dir(query.get("path", ["/"])[0])
+        if path is None:
+            self.send_error(404, "No such folder")
+            return
+        stream = CHANGE_FEED.subscribe(path)
+        if stream is None:
+            self.send_busy()
+            return
+        self.close_connection = True
+        try:
             self.send_response(200)
-            self.send_header("Content-type", "application/json; charset=utf-8")
-            self.send_header("Content-Length", str(len(encoded)))
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Cache-Control", "no-store")
             self.end_headers()
-            self.wfile.write(encoded)
-            return None
+            self.wfile.write(b"retry: 3000\n\n")
+            self.wfile.flush()
+            while True:
+                waited = CHANGE_FEED.wait(stream)
+                if waited is None:
+                    break
+                events, overflowed = waited
+                if overflowed:
+                    chunk = b"event: reset\ndata: {}\n\n"
+                elif events:
+                    chunk = b"".join(b"data: " + json.dumps(event).encode("utf-8") + b"\n\n"
+                                     for event in events)
+                else:
+                    chunk = b": ping\n\n"
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        except OSError:
+            pass  # browser navigated away or closed the tab
+        finally:
+            CHANGE_FEED.unsubscribe(stream)
 
-        # HTML for the full page
-        html = f"""<!DOCTYPE html>
-<html lang='en' data-theme='light'>
-<head>
-<meta charset='utf-8'><meta name='viewport' content='width=device-width, initial-scale=1'>
-<title>LAN File Share</title>
-<style>
-:root {{
+    def handle_thumbnail(self):
+        """GET /thumb/<file path>: cached JPEG preview, safe to cache forever (URLs carry ?v=)"""
+        source = self.translate_path(self.path[len("/thumb"):])
+        name = os.path.basename(source)
+        kind = thumbnail_kind(name)
+        if not kind or self.is_internal_path(source) or not os.path.isfile(source):
+            self.send_error(404, "No thumbnail")
+            return
+        try:
+            thumb = THUMBNAILS.get(source, os.stat(source), kind)
+            fs = os.stat(thumb)
+            entry = HOT_FILES.get(thumb, fs)
+            if entry is None:
+                with open(thumb, "rb") as f:
+                    entry = HOT_FILES.put(thumb, fs, f.read(), [])
+            data = entry.data
+        except (TimeoutError, FutureTimeoutError):
+            self.send_response(503)
+            self.send_header("Retry-After", "2")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        except FileNotFoundError:
+            self.send_error(404, "No thumbnail")  # gone, or known not to render
+            return
+        except Exception as e:
+            self.log_error("thumbnail of %s failed: %r", source, e)
+            self.send_error(500, "Thumbnail failed")
+            return
+        self.send_response(200)
+        self.send_header("Content-type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def list_directory(self, path):
+        """Every folder URL gets the same static app shell; entries come from /api/list"""
+        self.send_static(APP_SHELL, "no-cache")
+        return None
+
+    def handle_static_asset(self):
+        """GET /__app__/<name>.<hash>.<ext>: versioned CSS/JS, cacheable forever"""
+        asset = STATIC_ASSETS.get(urllib.parse.urlsplit(self.path).path[len(STATIC_PREFIX):])
+        if asset is None:
+            self.send_error(404, "File not found")
+            return
+        self.send_static(asset, "public, max-age=31536000, immutable")
+
+    def send_static(self, asset, cache_control):
+        """Send a StaticAsset, using its precompressed variant when the client accepts one"""
+        if self.is_not_modified(asset.etag):
+            self.send_not_modified(asset.etag, cache_control)
+            return
+        encoding = choose_encoding(self.headers.get("Accept-Encoding"))
+        data = asset.variants.get(encoding)
+        if data is None:
+            encoding, data = None, asset.variants[None]
+        self.send_response(200)
+        self.send_header("Content-type", asset.ctype)
+        self.send_header("Content-Length", str(len(data)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", asset.etag)
+        self.send_header("Cache-Control", cache_control)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+APP_CSS = """:root {
   --blue:#2196F3;
   --bg:#fff;
   --text:#212529;
@@ -274,8 +3650,8 @@ class CustomHandler(http.server.SimpleHTTPRequestHandler):
   --form-bg:#fff;
   --input-bg:#f8f9fa;
   --input-text:#212529;
-}}
-[data-theme=dark] {{
+}
+[data-theme=dark] {
   --bg:#121212;
   --text:#f1f1f1;
   --border:#333;
@@ -283,35 +3659,35 @@ class CustomHandler(http.server.SimpleHTTPRequestHandler):
   --form-bg:#1e1e1e;
   --input-bg:#2a2a2a;
   --input-text:#f1f1f1;
-}}
+}
 
-a {{
+a {
   color: var(--accent);
   text-decoration: none;
-}}
-a:hover {{
+}
+a:hover {
   text-decoration: underline;
-}}
+}
 
-body {{
+body {
   background:var(--bg);
   color:var(--text);
   font-family:sans-serif;
   margin:0;
   padding:1rem;
-}}
-button, input {{
+}
+button, input {
   font-size:1rem;
-}}
-.upload-form {{
+}
+.upload-form {
   max-width:500px;
   margin:auto;
   background:var(--form-bg);
   padding:1em;
   border-radius:8px;
   border:1px solid var(--border);
-}}
-input[type='file'] {{
+}
+input[type='file'] {
   background:var(--input-bg);
   color:var(--input-text);
   border:1px solid var(--border);
@@ -319,16 +3695,16 @@ input[type='file'] {{
   width:100%;
   border-radius:4px;
   margin-bottom:0.5em;
-}}
-input[type='submit'] {{
+}
+input[type='submit'] {
   background:var(--accent);
   color:white;
   padding:0.5em 1em;
   border:none;
   cursor:pointer;
   border-radius:4px;
-}}
-.toggle {{
+}
+.toggle {
   position:absolute;
   top:10px;
   right:10px;
@@ -338,23 +3714,125 @@ input[type='submit'] {{
   color:var(--text);
   cursor:pointer;
   border-radius:4px;
-}}
-table {{
-  width:100%;
-  border-collapse:collapse;
+}
+.list-tools {
+  display:flex;
+  gap:1em;
+  align-items:center;
   margin-top:1em;
-}}
-th, td {{
-  padding:0.5em;
+}
+.list-tools input {
+  flex:1;
+  padding:0.4em;
+  background:var(--input-bg);
+  color:var(--input-text);
+  border:1px solid var(--border);
+  border-radius:4px;
+}
+.list-tools button {
+  padding:0.4em 0.8em;
+  background:var(--accent);
+  color:white;
+  border:none;
+  border-radius:4px;
+  cursor:pointer;
+  white-space:nowrap;
+}
+.list-tools button:disabled {
+  opacity:0.5;
+  cursor:default;
+}
+.file-row .pick {
+  margin-right:0.5em;
+}
+#searchResults {
+  display:none;
+  margin-top:0.5em;
+  max-height:18em;
+  overflow-y:auto;
+  border:1px solid var(--border);
+  border-radius:4px;
+}
+#searchResults.open {
+  display:block;
+}
+#searchResults a {
+  display:block;
+  padding:0.3em 0.5em;
+  color:var(--text);
+  text-decoration:none;
+  border-bottom:1px solid var(--border);
+}
+#searchResults a:hover {
+  background:var(--input-bg);
+}
+#searchResults small {
+  opacity:0.6;
+  margin-left:0.5em;
+}
+.file-row {
+  display:grid;
+  grid-template-columns:minmax(0,3fr) 6em 10em 110px 12em;
+  gap:0.5em;
+  align-items:center;
+  height:64px;
+  padding:0 0.5em;
+  box-sizing:border-box;
   border-bottom:1px solid var(--border);
-}}
-img, video, audio {{
-  max-height:100px;
+}
+.file-row span {
+  overflow:hidden;
+  text-overflow:ellipsis;
+  white-space:nowrap;
+}
+.file-head {
+  height:auto;
+  padding:0.5em;
+  font-weight:bold;
+}
+.file-head span[data-sort] {
+  cursor:pointer;
+}
+#fileList {
+  height:70vh;
+  overflow-y:auto;
+}
+#fileSpacer {
+  position:relative;
+}
+.file-row.item {
+  position:absolute;
+  left:0;
+  right:0;
+}
+.file-row img, .file-row video, .file-row audio {
+  max-height:56px;
   max-width:100%;
   display:block;
   margin:auto;
-}}
-#toast {{
+}
+@media (max-width:700px) {
+  .file-row {
+    grid-template-columns:minmax(0,1fr) 5em 80px 6em;
+  }
+  .file-row .col-mtime {
+    display:none;
+  }
+}
+#progressBarContainer {
+  height:6px;
+  background:var(--input-bg);
+  border-radius:3px;
+  margin-top:0.5em;
+  overflow:hidden;
+}
+#progressBar {
+  height:100%;
+  width:0;
+  background:var(--accent);
+  transition:width 0.2s;
+}
+#toast {
   position:fixed;
   bottom:20px;
   left:50%;
@@ -364,8 +3842,8 @@ img, video, audio {{
   padding:10px 20px;
   border-radius:8px;
   display:none;
-}}
-.modal {{
+}
+.modal {
   display: none;
   position: fixed;
   top: 0;
@@ -374,46 +3852,18 @@ img, video, audio {{
   height: 100%;
   background: rgba(0,0,0,0.5);
   z-index: 1000;
-}}
-.modal-content {{
+}
+.modal-content {
   background: var(--form-bg);
   width: 300px;
   margin: 100px auto;
   padding: 20px;
   border-radius: 8px;
   box-shadow: 0 4px 8px rgba(0,0,0,0.2);
-}}
-</style></head>
-<body>
-<button class='toggle' onclick='toggleTheme()'>🌗</button>
-<div id="authButtonContainer">{auth_button}</div>
-<h2>📂 Folder: /{rel_path}</h2>
-<div class='upload-form'>
-  <form id='uploadForm' onsubmit='return uploadFile(event)'>
-    <input id='fileInput' name='file' type='file' required><br>
-    <input type='submit' value='Upload'>
-    <div id='progressBarContainer'><div id='progressBar'></div></div>
-  </form>
-</div>
-<div id='loader' style='display:none;text-align:center;'>🔄 Refreshing...</div>
-<table id='fileTable'><tr><th>Name</th><th>Size</th><th>Preview</th><th>Action</th></tr>
-""" + '\n'.join(rows) + """</table>
-<div id='toast'>Upload successful!</div>
-
-<div id="loginModal" class="modal">
-  <div class="modal-content">
-    <h3>Login Required</h3>
-    <form id="loginForm">
-      <input type="text" id="username" placeholder="Username" required style="width:100%;padding:8px;margin-bottom:10px">
-      <input type="password" id="password" placeholder="Password" required style="width:100%;padding:8px;margin-bottom:10px">
-      <button type="submit" style="background:#2196F3;color:white;border:none;padding:8px;width:100%;border-radius:4px">Login</button>
-    </form>
-    <button onclick="document.getElementById('loginModal').style.display='none'" style="background:#f44336;color:white;border:none;padding:8px;width:100%;margin-top:10px;border-radius:4px">Cancel</button>
-  </div>
-</div>
+}
+"""
 
-<script>
-let pendingOperation = null;
+APP_JS = r"""let pendingOperation = null;
 
 function toggleTheme() {
   const html = document.documentElement;
@@ -421,88 +3871,634 @@ function toggleTheme() {
   html.setAttribute('data-theme', theme);
   localStorage.setItem('theme', theme);
 }
-(function () {
-  const saved = localStorage.getItem('theme');
-  const system = window.matchMedia('(prefers-color-scheme: dark)').matches ? 'dark' : 'light';
-  document.documentElement.setAttribute('data-theme', saved || system);
-})();
-function uploadFile(event) {
+const UPLOAD_PARALLEL = 4;
+const UPLOAD_RETRIES = 20;
+async function uploadFile(event) {
   event.preventDefault();
   const form = document.getElementById('uploadForm');
-  const formData = new FormData(form);
-  fetch('/', { method: 'POST', body: formData }).then(res => {
-    if (res.ok) {
-      showToast('✅ Upload successful');
-      form.reset();
-      refreshFileList();
-    } else showToast('❌ Upload failed');
-  }).catch(() => showToast('⚠️ Upload error'));
+  const files = Array.from(document.getElementById('fileInput').files);
+  try {
+    let reused = 0;
+    for (const file of files) {
+      if (await placeExisting(file)) reused++;
+      else await uploadResumable(file);
+    }
+    showToast(reused ? `✅ Upload successful (${reused} already on the server, not re-sent)` : '✅ Upload successful');
+    form.reset();
+  } catch (err) {
+    console.error('Upload failed:', err);
+    showToast('❌ Upload failed, pick the file again to resume');
+  }
+  setProgress(0);
+  if (!liveUpdates()) refreshFileList();
   return false;
 }
-function refreshFileList() {
-  document.getElementById('loader').style.display = 'block';
-  fetch(window.location.href, { headers: { 'X-Requested-With': 'XMLHttpRequest' } })
+function setProgress(fraction) {
+  document.getElementById('progressBar').style.width = (fraction * 100).toFixed(1) + '%';
+}
+function sleep(ms) {
+  return new Promise(resolve => setTimeout(resolve, ms));
+}
+async function withRetry(action) {
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const res = await action();
+      if (res.ok || (res.status >= 400 && res.status < 500)) return res;
+    } catch (err) {
+      if (attempt >= UPLOAD_RETRIES) throw err;
+    }
+    if (attempt >= UPLOAD_RETRIES) throw new Error('Server kept failing');
+    await sleep(Math.min(30000, 500 * 2 ** attempt));
+  }
+}
+// SHA-256 in plain JS: crypto.subtle only exists on https pages and cannot hash incrementally
+const SHA256_K = new Int32Array([
+  0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+  0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+  0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+  0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+  0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+  0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+  0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+  0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+class Sha256 {
+  constructor() {
+    this.h = new Int32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+    this.w = new Int32Array(64);
+    this.block = new Uint8Array(64);
+    this.fill = 0;
+    this.length = 0;
+  }
+  update(bytes) {
+    this.length += bytes.length;
+    let i = 0;
+    if (this.fill) {
+      i = Math.min(64 - this.fill, bytes.length);
+      this.block.set(bytes.subarray(0, i), this.fill);
+      this.fill += i;
+      if (this.fill < 64) return this;
+      this.compress(this.block, 0);
+      this.fill = 0;
+    }
+    for (; i + 64 <= bytes.length; i += 64) this.compress(bytes, i);
+    if (i < bytes.length) {
+      this.block.set(bytes.subarray(i));
+      this.fill = bytes.length - i;
+    }
+    return this;
+  }
+  compress(bytes, offset) {
+    const w = this.w, k = SHA256_K, H = this.h;
+    for (let t = 0; t < 16; t++) {
+      const j = offset + t * 4;
+      w[t] = (bytes[j] << 24) | (bytes[j + 1] << 16) | (bytes[j + 2] << 8) | bytes[j + 3];
+    }
+    for (let t = 16; t < 64; t++) {
+      const x = w[t - 15], y = w[t - 2];
+      const s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+      const s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+      w[t] = (w[t - 16] + s0 + w[t - 7] + s1) | 0;
+    }
+    let a = H[0], b = H[1], c = H[2], d = H[3], e = H[4], f = H[5], g = H[6], h = H[7];
+    for (let t = 0; t < 64; t++) {
+      const S1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+      const t1 = (h + S1 + ((e & f) ^ (~e & g)) + k[t] + w[t]) | 0;
+      const S0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+      const t2 = (S0 + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+      h = g; g = f; f = e; e = (d + t1) | 0;
+      d = c; c = b; b = a; a = (t1 + t2) | 0;
+    }
+    H[0] += a; H[1] += b; H[2] += c; H[3] += d; H[4] += e; H[5] += f; H[6] += g; H[7] += h;
+  }
+  hex() {
+    const bits = this.length * 8;
+    const pad = new Uint8Array((this.fill < 56 ? 56 : 120) - this.fill + 8);
+    const view = new DataView(pad.buffer);
+    pad[0] = 0x80;
+    view.setUint32(pad.length - 8, Math.floor(bits / 0x100000000));
+    view.setUint32(pad.length - 4, bits >>> 0);
+    this.update(pad);
+    return Array.from(this.h, x => (x >>> 0).toString(16).padStart(8, '0')).join('');
+  }
+}
+const HASH_SLICE = 4 * 1024 * 1024;
+async function hashFile(file) {
+  const hash = new Sha256();
+  for (let offset = 0; offset < file.size; offset += HASH_SLICE) {
+    hash.update(new Uint8Array(await file.slice(offset, offset + HASH_SLICE).arrayBuffer()));
+    setProgress(Math.min(1, (offset + HASH_SLICE) / file.size));
+  }
+  return hash.hex();
+}
+async function placeExisting(file) {
+  // Hash only when the server holds a file of the same size, then let it copy that one
+  const ask = body => fetch('/api/upload/check', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(body)
+  }).then(res => res.ok ? res.json() : {});
+  try {
+    if (!(await ask({ size: file.size })).candidates) return false;
+    const sha256 = await hashFile(file);
+    const placed = await ask({ name: file.name, dir: location.pathname, size: file.size, sha256 });
+    return !!placed.exists;
+  } catch (err) {
+    console.warn('Duplicate check failed, uploading instead:', err);
+    return false;
+  }
+}
+async function uploadResumable(file) {
+  const key = `upload:${location.pathname}:${file.name}:${file.size}:${file.lastModified}`;
+  let info = null;
+  const savedId = localStorage.getItem(key);
+  if (savedId) {
+    const res = await withRetry(() => fetch('/api/upload/' + savedId));
+    if (res.ok) info = await res.json();
+  }
+  if (!info) {
+    const res = await withRetry(() => fetch('/api/upload/init', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ name: file.name, size: file.size, dir: location.pathname })
+    }));
+    if (!res.ok) throw new Error('Upload rejected: ' + res.status);
+    info = await res.json();
+    localStorage.setItem(key, info.id);
+  }
+
+  const total = Math.ceil(file.size / info.chunkSize);
+  const received = new Set(info.received);
+  const pending = [];
+  for (let i = 0; i < total; i++) if (!received.has(i)) pending.push(i);
+  let done = total - pending.length;
+  setProgress(total ? done / total : 1);
+
+  async function worker() {
+    while (pending.length) {
+      const index = pending.shift();
+      const offset = index * info.chunkSize;
+      const res = await withRetry(() => fetch(`/api/upload/${info.id}?offset=${offset}`, {
+        method: 'PUT',
+        body: file.slice(offset, offset + info.chunkSize)
+      }));
+      if (!res.ok) throw new Error('Chunk rejected: ' + res.status);
+      setProgress(++done / total);
+    }
+  }
+  await Promise.all(Array.from({ length: UPLOAD_PARALLEL }, worker));
+
+  const res = await withRetry(() => fetch(`/api/upload/${info.id}/complete`, { method: 'POST' }));
+  if (!res.ok) throw new Error('Could not finish upload: ' + res.status);
+  localStorage.removeItem(key);
+}
+const ROW_HEIGHT = 64;
+const PAGE_SIZE = 200;
+const OVERSCAN = 8;
+const listState = {
+  sort: 'name', order: 'asc', prefix: '', total: 0, authenticated: false, thumbnails: [],
+  generation: 0, pages: new Map(), loading: new Set(), rendered: new Map(), selected: new Set()
+};
+function listUrl(page) {
+  const params = new URLSearchParams({
+    path: location.pathname, offset: page * PAGE_SIZE, limit: PAGE_SIZE,
+    sort: listState.sort, order: listState.order, prefix: listState.prefix
+  });
+  return '/api/list?' + params;
+}
+function loadPage(page) {
+  if (listState.pages.has(page) || listState.loading.has(page)) return Promise.resolve();
+  const generation = listState.generation;
+  listState.loading.add(page);
+  return fetch(listUrl(page))
     .then(res => res.json())
     .then(data => {
-      document.getElementById('fileTable').innerHTML = data.table;
-      document.getElementById('authButtonContainer').innerHTML = data.authButton;
-      document.getElementById('loader').style.display = 'none';
+      if (generation !== listState.generation) return;
+      listState.loading.delete(page);
+      listState.pages.set(page, data.entries);
+      listState.total = data.total;
+      listState.thumbnails = data.thumbnails;
+      if (listState.authenticated !== data.authenticated) {
+        listState.authenticated = data.authenticated;
+        listState.rendered.clear();
+        document.getElementById('fileSpacer').replaceChildren();
+        updateAuthButton();
+      }
+      renderVisible();
     })
     .catch(err => {
-      console.error('Error refreshing file list:', err);
-      document.getElementById('loader').style.display = 'none';
+      listState.loading.delete(page);
+      console.error('Error loading file list:', err);
     });
 }
+function refreshFileList() {
+  listState.generation++;
+  listState.pages.clear();
+  listState.loading.clear();
+  document.getElementById('loader').style.display = 'block';
+  const list = document.getElementById('fileList');
+  const page = Math.floor(list.scrollTop / ROW_HEIGHT / PAGE_SIZE);
+  return loadPage(page).then(() => {
+    listState.rendered.clear();
+    document.getElementById('fileSpacer').replaceChildren();
+    renderVisible();
+    document.getElementById('loader').style.display = 'none';
+  });
+}
+function renderVisible() {
+  const list = document.getElementById('fileList');
+  const spacer = document.getElementById('fileSpacer');
+  spacer.style.height = (listState.total * ROW_HEIGHT) + 'px';
+  document.getElementById('entryCount').textContent = listState.total + ' items';
+  const first = Math.max(0, Math.floor(list.scrollTop / ROW_HEIGHT) - OVERSCAN);
+  const last = Math.min(listState.total, Math.ceil((list.scrollTop + list.clientHeight) / ROW_HEIGHT) + OVERSCAN);
+  const rendered = new Map();
+  for (let i = first; i < last; i++) {
+    const entries = listState.pages.get(Math.floor(i / PAGE_SIZE));
+    if (!entries) {
+      loadPage(Math.floor(i / PAGE_SIZE));
+      if (listState.rendered.has(i)) rendered.set(i, listState.rendered.get(i));  // keep until reloaded
+      continue;
+    }
+    const entry = entries[i % PAGE_SIZE];
+    if (!entry) continue;
+    let row = listState.rendered.get(i);
+    if (!row || row.dataset.key !== rowKey(entry)) {
+      row = buildRow(entry, i);
+      spacer.appendChild(row);
+    }
+    rendered.set(i, row);
+  }
+  for (const [i, row] of listState.rendered) {
+    if (rendered.get(i) !== row) row.remove();
+  }
+  listState.rendered = rendered;
+}
+function rowKey(entry) {
+  return [entry.name, entry.dir, entry.size, entry.mtime].join('|');
+}
+let liveEvents = null;
+let reloadTimer = null;
+function liveUpdates() {
+  return liveEvents !== null && liveEvents.readyState === EventSource.OPEN;
+}
+function connectEvents() {
+  if (liveEvents) liveEvents.close();
+  liveEvents = null;
+  if (!window.EventSource) return;
+  liveEvents = new EventSource('/api/events?path=' + encodeURIComponent(location.pathname));
+  liveEvents.onmessage = event => applyChange(JSON.parse(event.data));
+  liveEvents.addEventListener('reset', scheduleReload);
+}
+function scheduleReload() {
+  clearTimeout(reloadTimer);
+  reloadTimer = setTimeout(() => {
+    listState.generation++;
+    listState.pages.clear();
+    listState.loading.clear();
+    renderVisible();
+  }, 250);
+}
+function applyChange(change) {
+  if (listState.prefix && !change.name.toLowerCase().startsWith(listState.prefix.toLowerCase())) return;
+  for (const entries of listState.pages.values()) {
+    const index = entries.findIndex(entry => entry.name === change.name);
+    if (index < 0) continue;
+    if (change.entry && rowKey(change.entry) === rowKey(entries[index])) return;
+    if (change.entry && listState.sort === 'name') {
+      entries[index] = change.entry;  // same position, new details
+      renderVisible();
+      return;
+    }
+    break;
+  }
+  scheduleReload();  // rows shift: refetch only the visible pages
+}
+function cell(content, className) {
+  const span = document.createElement('span');
+  if (className) span.className = className;
+  if (typeof content === 'string') span.textContent = content;
+  else if (content) span.appendChild(content);
+  return span;
+}
+function formatSize(bytes) {
+  return (bytes / (1024 * 1024)).toFixed(2) + ' MB';
+}
+function thumbnailImage(entry, href, fallback) {
+  const img = document.createElement('img');
+  img.loading = 'lazy';
+  img.decoding = 'async';
+  img.alt = '';
+  img.src = `/thumb${location.pathname}${href}?v=${entry.mtime}-${entry.size}`;
+  img.onerror = () => {
+    img.onerror = null;
+    if (fallback) img.src = fallback;
+    else img.remove();
+  };
+  return img;
+}
+function previewFor(entry, href) {
+  const name = entry.name.toLowerCase();
+  const thumbs = listState.thumbnails;
+  if (/\.(png|jpe?g|gif|webp|bmp)$/.test(name)) {
+    if (thumbs.includes('image')) return thumbnailImage(entry, href, href);
+    const img = document.createElement('img');
+    img.loading = 'lazy';
+    img.src = href;
+    return img;
+  }
+  if (/\.(mp4|webm|mkv|mov|avi)$/.test(name)) {
+    if (thumbs.includes('video')) return thumbnailImage(entry, href, null);
+    const video = document.createElement('video');
+    video.controls = true;
+    video.preload = 'none';
+    video.src = href;
+    return video;
+  }
+  if (/\.(mp3|wav|ogg)$/.test(name)) {
+    const audio = document.createElement('audio');
+    audio.controls = true;
+    audio.preload = 'none';
+    audio.src = href;
+    return audio;
+  }
+  return null;
+}
+function buildRow(entry, index) {
+  const row = document.createElement('div');
+  row.className = 'file-row item';
+  row.style.top = (index * ROW_HEIGHT) + 'px';
+  row.dataset.name = entry.name;
+  row.dataset.key = rowKey(entry);
+  const label = entry.name + (entry.dir ? '/' : '');
+  const href = encodeURIComponent(entry.name) + (entry.dir ? '/' : '');
+  const link = document.createElement('a');
+  link.href = href;
+  link.textContent = label;
+  link.title = label;
+  if (entry.dir) link.addEventListener('click', followFolderLink);
+  const pick = document.createElement('input');
+  pick.type = 'checkbox';
+  pick.className = 'pick';
+  pick.checked = listState.selected.has(entry.name);
+  pick.addEventListener('change', () => {
+    if (pick.checked) listState.selected.add(entry.name);
+    else listState.selected.delete(entry.name);
+    updateSelection();
+  });
+  const name = cell(pick);
+  name.appendChild(link);
+  let actions;
+  if (listState.authenticated) {
+    actions = document.createElement('span');
+    const del = document.createElement('button');
+    del.textContent = '🗑 Delete';
+    del.onclick = () => deleteFile(label);
+    const ren = document.createElement('button');
+    ren.textContent = '✏ Rename';
+    ren.onclick = () => renameFile(label);
+    actions.append(del, ' ', ren);
+  } else {
+    actions = 'Login required';
+  }
+  row.append(
+    name,
+    cell(entry.dir ? '-' : formatSize(entry.size)),
+    cell(new Date(entry.mtime * 1000).toLocaleString(), 'col-mtime'),
+    cell(entry.dir ? null : previewFor(entry, href)),
+    cell(actions)
+  );
+  return row;
+}
+function updateSelection() {
+  const count = listState.selected.size;
+  document.getElementById('zipButton').textContent = count ? `⬇ Download ${count} selected` : '⬇ Download all';
+  document.getElementById('deleteSelectedButton').disabled = !count;
+  document.getElementById('moveSelectedButton').disabled = !count;
+}
+function downloadZip() {
+  const form = document.createElement('form');
+  form.method = 'POST';
+  form.action = '/download-zip';
+  const fields = [['dir', location.pathname], ...Array.from(listState.selected, name => ['name', name])];
+  for (const [key, value] of fields) {
+    const input = document.createElement('input');
+    input.type = 'hidden';
+    input.name = key;
+    input.value = value;
+    form.appendChild(input);
+  }
+  document.body.appendChild(form);
+  form.submit();
+  form.remove();
+}
+function updateAuthButton() {
+  document.getElementById('authButtonContainer').innerHTML = listState.authenticated
+    ? '<button onclick="logout()" style="position:absolute;top:10px;right:100px;">Logout</button>'
+    : '<button onclick="showLoginModal()" style="position:absolute;top:10px;right:100px;">Login</button>';
+}
+function setSort(key) {
+  if (listState.sort === key) listState.order = listState.order === 'asc' ? 'desc' : 'asc';
+  else {
+    listState.sort = key;
+    listState.order = 'asc';
+  }
+  document.getElementById('fileList').scrollTop = 0;
+  refreshFileList();
+}
+let scrollQueued = false;
+document.getElementById('fileList').addEventListener('scroll', () => {
+  if (scrollQueued) return;
+  scrollQueued = true;
+  requestAnimationFrame(() => {
+    scrollQueued = false;
+    renderVisible();
+  });
+});
+document.querySelectorAll('.file-head span[data-sort]').forEach(span => {
+  span.addEventListener('click', () => setSort(span.dataset.sort));
+});
+let filterTimer = null;
+document.getElementById('filterInput').addEventListener('input', event => {
+  clearTimeout(filterTimer);
+  filterTimer = setTimeout(() => {
+    listState.prefix = event.target.value;
+    document.getElementById('fileList').scrollTop = 0;
+    refreshFileList();
+  }, 200);
+});
+window.addEventListener('resize', renderVisible);
+let searchTimer = null;
+let searchGeneration = 0;
+function pathHref(path, isDir) {
+  return path.split('/').map(encodeURIComponent).join('/') + (isDir ? '/' : '');
+}
+function closeSearch() {
+  const panel = document.getElementById('searchResults');
+  panel.classList.remove('open');
+  panel.replaceChildren();
+}
+async function runSearch(text) {
+  const generation = ++searchGeneration;
+  const panel = document.getElementById('searchResults');
+  if (!text.trim()) {
+    closeSearch();
+    return;
+  }
+  let data;
+  try {
+    const res = await fetch('/api/search?limit=50&q=' + encodeURIComponent(text));
+    data = await res.json();
+  } catch (err) {
+    return;
+  }
+  if (generation !== searchGeneration) return;
+  panel.replaceChildren();
+  for (const result of data.results) {
+    const slash = result.path.lastIndexOf('/');
+    const link = document.createElement('a');
+    link.href = pathHref(result.path, result.dir);
+    link.textContent = (result.dir ? '📁 ' : '📄 ') + result.path.slice(slash + 1) + (result.dir ? '/' : '');
+    const where = document.createElement('small');
+    where.textContent = result.path.slice(0, slash + 1);
+    link.appendChild(where);
+    if (result.dir) {
+      link.addEventListener('click', event => {
+        closeSearch();
+        followFolderLink(event);
+      });
+    }
+    panel.appendChild(link);
+  }
+  if (!data.results.length) {
+    const empty = document.createElement('a');
+    empty.textContent = data.ready ? 'No matches' : 'Index is still being built...';
+    panel.appendChild(empty);
+  } else if (data.total > data.results.length) {
+    const more = document.createElement('a');
+    more.textContent = (data.total - data.results.length) + (data.capped ? '+' : '') + ' more matches, refine the search';
+    panel.appendChild(more);
+  }
+  panel.classList.add('open');
+}
+document.getElementById('searchInput').addEventListener('input', event => {
+  clearTimeout(searchTimer);
+  searchTimer = setTimeout(() => runSearch(event.target.value), 150);
+});
+document.getElementById('searchInput').addEventListener('keydown', event => {
+  if (event.key === 'Escape') {
+    event.target.value = '';
+    closeSearch();
+  }
+});
+function followFolderLink(event) {
+  if (event.button !== 0 || event.ctrlKey || event.metaKey || event.shiftKey || event.altKey) return;
+  event.preventDefault();
+  history.pushState(null, '', event.currentTarget.href);
+  openFolder();
+}
+function renderTitle() {
+  const title = document.getElementById('folderTitle');
+  title.replaceChildren('📂 Folder: ');
+  let path = '/';
+  const crumbs = [['/', '/']];
+  for (const part of location.pathname.split('/').filter(Boolean)) {
+    path += part + '/';
+    crumbs.push([decodeURIComponent(part) + '/', path]);
+  }
+  for (const [label, href] of crumbs) {
+    const link = document.createElement('a');
+    link.href = href;
+    link.textContent = label;
+    link.addEventListener('click', followFolderLink);
+    title.appendChild(link);
+  }
+  document.title = 'LAN File Share - ' + decodeURIComponent(location.pathname);
+}
+function openFolder() {
+  listState.prefix = '';
+  listState.selected.clear();
+  updateSelection();
+  document.getElementById('filterInput').value = '';
+  document.getElementById('fileList').scrollTop = 0;
+  renderTitle();
+  refreshFileList();
+  connectEvents();
+}
+window.addEventListener('popstate', openFolder);
+updateAuthButton();
+renderTitle();
+refreshFileList();
+connectEvents();
 function showToast(msg) {
   const toast = document.getElementById('toast');
   toast.textContent = msg;
   toast.style.display = 'block';
   setTimeout(() => toast.style.display = 'none', 3000);
 }
-function deleteFile(filename) {
-  if (!confirm(`Are you sure you want to delete "${filename}"?`)) return;
-  
-  const operation = () => {
-    fetch('/delete', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ filename })
-    }).then(res => {
-      if (res.ok) {
-        showToast('🗑 File deleted');
-        refreshFileList();
-      } else if (res.status === 401) {
-        showLoginModal(() => deleteFile(filename));
-      } else {
-        showToast('❌ Delete failed');
-      }
-    });
-  };
-  
-  operation();
+async function runBatch(ops, retry) {
+  const res = await fetch('/api/batch', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ dir: location.pathname, ops })
+  });
+  if (res.status === 401) {
+    showLoginModal(retry);
+    return null;
+  }
+  if (!res.ok) {
+    showToast('❌ Request failed');
+    return null;
+  }
+  const data = await res.json();
+  ops.forEach((op, i) => {
+    if (data.results[i].ok) listState.selected.delete(op.name);
+  });
+  updateSelection();
+  if (!liveUpdates()) refreshFileList();
+  return data;
+}
+function batchToast(data, verb) {
+  if (!data) return;
+  if (!data.failed) {
+    showToast(`✅ ${verb} ${data.done}`);
+    return;
+  }
+  const first = data.results.find(result => !result.ok);
+  showToast(`⚠ ${verb} ${data.done}, ${data.failed} failed (${first.error})`);
+}
+function stripSlash(name) {
+  return name.endsWith('/') ? name.slice(0, -1) : name;
+}
+async function deleteFile(label) {
+  if (!confirm(`Are you sure you want to delete "${label}"?`)) return;
+  batchToast(await runBatch([{ op: 'delete', name: stripSlash(label) }], () => deleteFile(label)), 'Deleted');
 }
-function renameFile(oldName) {
-  const newName = prompt("Enter new filename:", oldName);
+async function renameFile(label) {
+  const oldName = stripSlash(label);
+  const newName = prompt("Enter new name:", oldName);
   if (!newName || newName === oldName) return;
-  
-  const operation = () => {
-    fetch('/rename', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ oldName, newName })
-    }).then(res => {
-      if (res.ok) {
-        showToast('✏ File renamed');
-        refreshFileList();
-      } else if (res.status === 401) {
-        showLoginModal(() => renameFile(oldName));
-      } else {
-        showToast('❌ Rename failed');
-      }
-    });
-  };
-  
-  operation();
+  batchToast(await runBatch([{ op: 'rename', name: oldName, to: newName }], () => renameFile(label)), 'Renamed');
+}
+async function deleteSelected() {
+  const names = Array.from(listState.selected);
+  if (!names.length || !confirm(`Delete ${names.length} selected item(s)?`)) return;
+  batchToast(await runBatch(names.map(name => ({ op: 'delete', name })), deleteSelected), 'Deleted');
+}
+async function moveSelected() {
+  const names = Array.from(listState.selected);
+  if (!names.length) return;
+  let dest = prompt('Move to folder (path from the share root):', location.pathname);
+  if (!dest) return;
+  if (!dest.startsWith('/')) dest = '/' + dest;
+  if (!dest.endsWith('/')) dest += '/';
+  const href = dest.split('/').map(encodeURIComponent).join('/');
+  batchToast(await runBatch(names.map(name => ({ op: 'move', name, dest: href })), moveSelected), 'Moved');
+}
+async function createFolder() {
+  const name = prompt('New folder name:');
+  if (!name) return;
+  batchToast(await runBatch([{ op: 'mkdir', name }], createFolder), 'Created');
 }
 function showLoginModal(operation) {
   pendingOperation = operation;
@@ -537,19 +4533,95 @@ function logout() {
       }
     });
 }
-</script></body></html>"""
+"""
 
-        encoded = html.encode('utf-8', 'surrogateescape')
-        self.send_response(200)
-        self.send_header("Content-type", "text/html; charset=utf-8")
-        self.send_header("Content-Length", str(len(encoded)))
-        self.end_headers()
-        self.wfile.write(encoded)
+# Only {css} and {js} may appear in braces here; the shell goes through str.format
+APP_SHELL_TEMPLATE = """<!DOCTYPE html>
+<html lang='en' data-theme='light'>
+<head>
+<meta charset='utf-8'><meta name='viewport' content='width=device-width, initial-scale=1'>
+<title>LAN File Share</title>
+<link rel='stylesheet' href='{css}'>
+<script>document.documentElement.setAttribute('data-theme', localStorage.getItem('theme') || (matchMedia('(prefers-color-scheme: dark)').matches ? 'dark' : 'light'));</script>
+</head>
+<body>
+<button class='toggle' onclick='toggleTheme()'>🌗</button>
+<div id="authButtonContainer"></div>
+<h2 id='folderTitle'>📂 Folder: /</h2>
+<div class='upload-form'>
+  <form id='uploadForm' onsubmit='return uploadFile(event)'>
+    <input id='fileInput' name='file' type='file' multiple required><br>
+    <input type='submit' value='Upload'>
+    <div id='progressBarContainer'><div id='progressBar'></div></div>
+  </form>
+</div>
+<div id='loader' style='display:none;text-align:center;'>🔄 Refreshing...</div>
+<div class='list-tools'>
+  <input id='filterInput' type='search' placeholder='Filter by name prefix...'>
+  <span id='entryCount'></span>
+  <button id='zipButton' type='button' onclick='downloadZip()'>⬇ Download all</button>
+  <button id='deleteSelectedButton' type='button' onclick='deleteSelected()' disabled>🗑 Delete</button>
+  <button id='moveSelectedButton' type='button' onclick='moveSelected()' disabled>📁 Move</button>
+  <button type='button' onclick='createFolder()'>➕ Folder</button>
+  <input id='searchInput' type='search' placeholder='Search all folders...'>
+</div>
+<div id='searchResults'></div>
+<div class='file-row file-head'>
+  <span data-sort='name'>Name</span><span data-sort='size'>Size</span><span data-sort='mtime' class='col-mtime'>Modified</span><span>Preview</span><span>Action</span>
+</div>
+<div id='fileList'><div id='fileSpacer'></div></div>
+<div id='toast'>Upload successful!</div>
+
+<div id="loginModal" class="modal">
+  <div class="modal-content">
+    <h3>Login Required</h3>
+    <form id="loginForm">
+      <input type="text" id="username" placeholder="Username" required style="width:100%;padding:8px;margin-bottom:10px">
+      <input type="password" id="password" placeholder="Password" required style="width:100%;padding:8px;margin-bottom:10px">
+      <button type="submit" style="background:#2196F3;color:white;border:none;padding:8px;width:100%;border-radius:4px">Login</button>
+    </form>
+    <button onclick="document.getElementById('loginModal').style.display='none'" style="background:#f44336;color:white;border:none;padding:8px;width:100%;margin-top:10px;border-radius:4px">Cancel</button>
+  </div>
+</div>
+
+<script src='{js}'></script>
+</body></html>"""
+
+class StaticAsset:
+    """In-memory response body with a content-hash ETag and precompressed variants"""
+    def __init__(self, ctype, text):
+        data = text.encode("utf-8")
+        self.ctype = ctype
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        self.etag = f'"{self.digest}"'
+        self.variants = {None: data, "gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(data, quality=11)
+
+def build_static_assets():
+    assets = {}
+    urls = {}
+    for key, ctype, text in (("css", "text/css; charset=utf-8", APP_CSS),
+                             ("js", "application/javascript; charset=utf-8", APP_JS)):
+        asset = StaticAsset(ctype, text)
+        name = f"app.{asset.digest}.{key}"
+        assets[name] = asset
+        urls[key] = STATIC_PREFIX + name
+    return assets, StaticAsset("text/html; charset=utf-8", APP_SHELL_TEMPLATE.format(**urls))
 
-def stop_server(httpd):
+STATIC_ASSETS, APP_SHELL = build_static_assets()
+
+def stop_server(httpd, drain=0):
+    CHANGE_FEED.close()  # let open event streams finish first
     if httpd:
         httpd.shutdown()
+        httpd.drain(drain)
         httpd.server_close()
+    THUMBNAILS.close()
+    SESSIONS.stop_sweeper()
+    SEARCH_INDEX.stop()
+    HASH_INDEX.stop()
+    UPLOAD_SWEEPER.stop()
 
 class App:
     def __init__(self, root):
@@ -558,7 +4630,6 @@ class App:
         self.httpd = None
         self.countdown = 60
         self.timer_label = None
-        self.timer_thread = None
 
         self.setup_ui()
 
@@ -569,6 +4640,13 @@ class App:
         sys.stderr = TextRedirector(self.log_output, "stderr")
 
         self.start_countdown()
+        self.refresh_stats()
+
+    def refresh_stats(self):
+        """Redraw the stats panel from METRICS (full detail at /metrics)"""
+        if self.httpd is not None:
+            self.stats_label.config(text=METRICS.summary())
+        self.root.after(STATS_REFRESH_MS, self.refresh_stats)
 
     def setup_ui(self):
         self.container = tk.Frame(self.root, bg="#f4f4f4", padx=20, pady=20)
@@ -600,6 +4678,19 @@ class App:
         
         tk.Button(auth_frame, text="Apply Credentials", command=self.update_credentials, 
                  bg="#4CAF50", fg="white").grid(row=2, column=0, columnspan=2, pady=5, sticky="ew")
+
+        server_frame = tk.LabelFrame(self.container, text="Server Settings", padx=10, pady=10, bg="#f4f4f4")
+        server_frame.pack(fill=tk.X, pady=10)
+
+        tk.Label(server_frame, text="Max connections:", bg="#f4f4f4").grid(row=0, column=0, sticky="e", padx=5, pady=2)
+        self.max_connections_var = tk.IntVar(value=MAX_CONNECTIONS)
+        tk.Spinbox(server_frame, from_=1, to=256, textvariable=self.max_connections_var, width=6).grid(row=0, column=1, sticky="w", padx=5, pady=2)
+
+        stats_frame = tk.LabelFrame(self.container, text="Server Stats", padx=10, pady=10, bg="#f4f4f4")
+        stats_frame.pack(fill=tk.X, pady=10)
+        self.stats_label = tk.Label(stats_frame, text="Server not running", justify=tk.LEFT, anchor="w",
+                                    font=("Courier", 9), bg="#f4f4f4")
+        self.stats_label.pack(fill=tk.X)
         
         self.btn_stop = tk.Button(self.container, text="Stop Server", command=self.stop_server, font=("Arial", 14), bg="#FF6347", fg="white", state=tk.DISABLED)
         self.btn_stop.pack(pady=10, fill=tk.X)
@@ -617,35 +4708,35 @@ class App:
         AUTH_PASSWORD = self.password_var.get()
         
         # Clear existing sessions
-        global SESSION_TOKENS
-        SESSION_TOKENS = {}
+        SESSIONS.clear()
         
         messagebox.showinfo("Credentials Updated", 
                           f"Authentication credentials updated\nUsername: {AUTH_USERNAME}\n"
                           "All existing sessions have been invalidated")
 
-    def start_countdown(self):
-        def countdown():
-            while self.countdown > 0:
-                if FOLDER_SELECTED is not None:
-                    break
-                self.countdown -= 1
-                self.timer_label.config(text=f"Time left: {self.countdown}s")
-                self.root.update()
-                time.sleep(1)
-
-            if self.countdown == 0 and FOLDER_SELECTED is None:
-                self.use_current_directory()
+    def get_max_connections(self):
+        try:
+            return max(1, self.max_connections_var.get())
+        except tk.TclError:
+            return MAX_CONNECTIONS
 
-        self.timer_thread = threading.Thread(target=countdown, daemon=True)
-        self.timer_thread.start()
+    def start_countdown(self):
+        """Share the current folder if nobody picks one in time (runs on the Tk thread)"""
+        if FOLDER_SELECTED is not None:
+            return
+        if self.countdown <= 0:
+            self.use_current_directory()
+            return
+        self.countdown -= 1
+        self.timer_label.config(text=f"Time left: {self.countdown}s")
+        self.root.after(1000, self.start_countdown)
 
     def choose_folder(self):
         folder = filedialog.askdirectory()
         if folder:
             global FOLDER_SELECTED
             FOLDER_SELECTED = folder
-            self.httpd = start_server(folder)
+            self.httpd = start_server(folder, self.get_max_connections())
             ip = get_ip()
             link = f"http://{ip}:{PORT}"
             self.label_link.config(text=f"Now Sharing:\n{link}")
@@ -658,7 +4749,7 @@ class App:
         global FOLDER_SELECTED
         if FOLDER_SELECTED is None:
             FOLDER_SELECTED = os.getcwd()
-            self.httpd = start_server(FOLDER_SELECTED)
+            self.httpd = start_server(FOLDER_SELECTED, self.get_max_connections())
             ip = get_ip()
             link = f"http://{ip}:{PORT}"
             self.label_link.config(text=f"Now Sharing:\n{link}")
@@ -670,10 +4761,360 @@ class App:
         self.label_link.config(text="Server stopped.")
         self.btn_stop.config(state=tk.DISABLED)
 
+SETTINGS_ENV = {  # setting -> environment variable
+    "root": "LANSHARE_ROOT",
+    "port": "LANSHARE_PORT",
+    "bind": "LANSHARE_BIND",
+    "username": "LANSHARE_USERNAME",
+    "password": "LANSHARE_PASSWORD",
+    "max_connections": "LANSHARE_MAX_CONNECTIONS",
+    "workers": "LANSHARE_WORKERS",
+}
+
+def load_settings(argv):
+    """Settings from the command line, then LANSHARE_* variables, then a JSON config file.
+
+    The config file (--config or LANSHARE_CONFIG) holds the same keys as
+    the options, e.g. {"root": "D:/Share", "port": 8000, "password": "..."}.
+    Prefer it or the environment for the password: arguments are visible
+    to every user of the machine.
+    """
+    parser = argparse.ArgumentParser(description="LAN file share server. With --root (or --headless) it "
+                                                 "serves straight away without opening a window.")
+    parser.add_argument("--root", help="folder to share")
+    parser.add_argument("--port", type=int, help=f"TCP port (default {PORT})")
+    parser.add_argument("--bind", help="address to listen on (default: all interfaces)")
+    parser.add_argument("--username", help="login name for delete, rename and other changes")
+    parser.add_argument("--password", help="login password")
+    parser.add_argument("--max-connections", type=int, dest="max_connections",
+                        help=f"connections served at once (default {MAX_CONNECTIONS})")
+    parser.add_argument("--workers", type=int, help="serving processes in headless mode (default "
+                                                   f"{WORKER_PROCESSES}, 0 = one per CPU core); "
+                                                   "with several, SIGHUP reloads them gracefully")
+    parser.add_argument("--config", default=os.environ.get("LANSHARE_CONFIG"), help="JSON settings file")
+    parser.add_argument("--headless", action="store_true", help="run without the window even if --root is not given")
+    args = parser.parse_args(argv)
+
+    settings = {}
+    if args.config:
+        try:
+            with open(args.config, encoding="utf-8") as f:
+                settings.update(json.load(f))
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot read config file {args.config}: {e}")
+    for key, env in SETTINGS_ENV.items():
+        if os.environ.get(env):
+            settings[key] = os.environ[env]
+    for key in SETTINGS_ENV:
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    try:
+        for key in ("port", "max_connections", "workers"):
+            if key in settings:
+                settings[key] = int(settings[key])
+    except ValueError:
+        parser.error(f"{key} must be a number")
+    settings["headless"] = args.headless or "root" in settings
+    return settings
+
+def apply_settings(settings):
+    global PORT, BIND_ADDRESS, AUTH_USERNAME, AUTH_PASSWORD
+    PORT = settings.get("port", PORT)
+    BIND_ADDRESS = settings.get("bind", BIND_ADDRESS)
+    AUTH_USERNAME = settings.get("username", AUTH_USERNAME)
+    AUTH_PASSWORD = settings.get("password", AUTH_PASSWORD)
+
+def attach_log():
+    if sys.stdout is None:  # windowed PyInstaller build started without a console
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        sys.stdout = sys.stderr = open(os.path.join(CACHE_DIR, "server.log"), "a", buffering=1, encoding="utf-8")
+
+def worker_count(settings):
+    return max(1, settings.get("workers", WORKER_PROCESSES) or os.cpu_count() or 1)
+
+def worker_main(settings, index, count, sessions, listen_socket, conn):
+    """Entry point of a WorkerPool process: serve from the shared socket until told to stop"""
+    global FOLDER_SELECTED, TRANSFER_SLOTS, GLOBAL_RATE_LIMIT, SCHEDULER, INSTANCE_ID
+    attach_log()
+    apply_settings(settings)
+    FOLDER_SELECTED = settings["root"]
+    INSTANCE_ID = settings["instance_id"]  # the master's, so every worker hands out the same listing ETags
+    for signum in (signal.SIGINT, getattr(signal, "SIGBREAK", None), getattr(signal, "SIGHUP", None)):
+        if signum is not None:
+            signal.signal(signum, signal.SIG_IGN)  # console signals reach every process; the master decides
+    signal.signal(signal.SIGTERM, lambda *_: BUS.stopping.set())
+
+    # process-wide limits are shared out between the workers
+    TRANSFER_SLOTS = threading.BoundedSemaphore(max(1, MAX_TRANSFERS // count))
+    GLOBAL_RATE_LIMIT /= count
+    SCHEDULER = TransferScheduler()
+    THUMBNAILS.workers = max(1, THUMB_WORKERS // count)
+    HOT_FILES.budget //= count
+    METRICS.constant_labels = f'worker="{index}"'
+
+    for token, expiry in sessions.items():
+        SESSIONS.adopt(token, expiry)
+    BUS.on("session", SESSIONS.adopt)
+    BUS.on("logout", SESSIONS.revoke)
+    BUS.on("changed", apply_entry_changes)
+    BUS.on("stop", BUS.stopping.set)
+    BUS.attach(conn)
+    listen_socket.setblocking(False)  # siblings accept from it too; losing the race must not block
+    httpd = start_server(FOLDER_SELECTED, settings.get("max_connections", MAX_CONNECTIONS),
+                         listen_socket, maintenance=index == 0)
+    BUS.send("ready")
+    BUS.stopping.wait()
+    stop_server(httpd, drain=WORKER_DRAIN_TIMEOUT)
+
+class WorkerProcess:
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn  # the master's end of the bus pipe
+        self.ready = False
+        self.retiring = None  # time.monotonic() when told to stop
+
+class WorkerPool:
+    """Pre-started serving processes sharing one listening socket.
+
+    The master binds the port and hands the socket to every worker, which
+    accepts from it directly, so connections go to whichever worker is
+    idle and the master never touches request data. Workers are spawned,
+    not forked, so Windows behaves the same. The master relays bus
+    messages, keeps a copy of the live sessions for workers it starts
+    later, and replaces workers that die. reload() starts a new set of
+    workers and retires the old set only once the new one is serving, so
+    no connection is refused in between.
+    """
+    def __init__(self, settings, count):
+        self.settings = settings
+        self.count = count
+        self.context = multiprocessing.get_context("spawn")
+        self.lock = threading.Lock()  # guards self.workers and writes to their pipes
+        self.workers = []
+        self.sessions = {}  # token -> expiry, as announced on the bus
+        self.socket = None
+        self.closed = threading.Event()
+
+    @staticmethod
+    def listen(settings):
+        return socket.create_server((settings.get("bind", BIND_ADDRESS), settings.get("port", PORT)),
+                                    backlog=MAX_PENDING_CONNECTIONS)
+
+    def start(self):
+        """Bind the port and start the workers; raises OSError or RuntimeError on failure"""
+        self.socket = self.listen(self.settings)
+        threading.Thread(target=self.relay, name="worker-relay", daemon=True).start()
+        with self.lock:
+            self.workers = [self.spawn(index) for index in range(self.count)]
+        self.wait_ready(self.workers)
+
+    def spawn(self, index):
+        now = time.time()
+        sessions = {token: expiry for token, expiry in list(self.sessions.items()) if expiry > now}
+        conn, child_conn = self.context.Pipe()
+        settings = dict(self.settings, instance_id=INSTANCE_ID)
+        process = self.context.Process(target=worker_main, name=f"lanshare-worker-{index}", args=(
+            settings, index, self.count, sessions, self.socket, child_conn))
+        process.start()
+        child_conn.close()
+        return WorkerProcess(index, process, conn)
+
+    def wait_ready(self, workers, timeout=WORKER_START_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while not all(worker.ready for worker in workers):
+            if any(worker.process.exitcode is not None for worker in workers):
+                raise RuntimeError("a worker process exited while starting")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"workers did not start within {timeout} s")
+            time.sleep(0.05)
+
+    def relay(self):
+        while not self.closed.is_set():
+            with self.lock:
+                by_conn = {worker.conn: worker for worker in self.workers if not worker.conn.closed}
+            if not by_conn:
+                self.closed.wait(0.5)
+                continue
+            try:
+                readable = multiprocessing.connection.wait(list(by_conn), timeout=0.5)
+            except (OSError, ValueError):
+                continue  # a pipe was closed under us; take a fresh list
+            for conn in readable:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    conn.close()
+                    continue
+                kind = message[0]
+                if kind == "ready":
+                    by_conn[conn].ready = True
+                    continue
+                if kind == "session":
+                    self.sessions[message[1]] = message[2]
+                    if len(self.sessions) > MAX_SESSIONS:
+                        del self.sessions[next(iter(self.sessions))]
+                elif kind == "logout":
+                    self.sessions.pop(message[1], None)
+                self.broadcast(message, skip=conn)
+
+    def broadcast(self, message, skip=None):
+        with self.lock:
+            for worker in self.workers:
+                if worker.conn is skip or worker.conn.closed:
+                    continue
+                try:
+                    worker.conn.send(message)
+                except (OSError, ValueError):
+                    pass
+
+    def retire(self, workers):
+        with self.lock:
+            for worker in workers:
+                worker.retiring = time.monotonic()
+                try:
+                    worker.conn.send(("stop",))
+                except (OSError, ValueError):
+                    pass
+
+    def check(self):
+        """Replace workers that died and forget retired ones that have finished"""
+        with self.lock:
+            for i, worker in enumerate(self.workers):
+                if worker.process.exitcode is None:
+                    if worker.retiring and time.monotonic() > worker.retiring + WORKER_DRAIN_TIMEOUT + 5:
+                        worker.process.terminate()  # stuck past its drain time
+                    continue
+                worker.conn.close()
+                if worker.retiring:
+                    self.workers[i] = None
+                    continue
+                print(f"Worker {worker.index} exited with code {worker.process.exitcode}; restarting it")
+                self.workers[i] = self.spawn(worker.index)
+            self.workers = [worker for worker in self.workers if worker is not None]
+
+    def reload(self, settings):
+        """Start workers with new settings, then retire the old ones; False keeps the old ones running"""
+        old_socket = None
+        if (settings.get("bind", BIND_ADDRESS), settings.get("port", PORT)) != \
+                (self.settings.get("bind", BIND_ADDRESS), self.settings.get("port", PORT)):
+            try:
+                old_socket, self.socket = self.socket, self.listen(settings)
+            except OSError as e:
+                print(f"Reload failed, cannot listen on the new address: {e}")
+                return False
+        if (settings.get("username"), settings.get("password")) != \
+                (self.settings.get("username"), self.settings.get("password")):
+            self.sessions.clear()  # new credentials log everyone out, as in the App window
+        previous = self.settings, self.count
+        self.settings, self.count = settings, worker_count(settings)
+        with self.lock:
+            old = [worker for worker in self.workers if not worker.retiring]
+            new = [self.spawn(index) for index in range(self.count)]
+            self.workers.extend(new)
+        try:
+            self.wait_ready(new)
+        except RuntimeError as e:
+            print(f"Reload failed, keeping the running workers: {e}")
+            self.retire(new)
+            if old_socket is not None:
+                self.socket.close()
+                self.socket = old_socket
+            self.settings, self.count = previous
+            return False
+        self.retire(old)
+        if old_socket is not None:
+            old_socket.close()  # the retiring workers hold their own copies until they exit
+        return True
+
+    def stop(self):
+        with self.lock:
+            workers = list(self.workers)
+        self.retire(workers)
+        deadline = time.monotonic() + WORKER_DRAIN_TIMEOUT + 5
+        for worker in workers:
+            worker.process.join(max(0, deadline - time.monotonic()))
+            if worker.process.exitcode is None:
+                worker.process.terminate()
+                worker.process.join(1)
+        self.closed.set()
+        if self.socket is not None:
+            self.socket.close()
+
+def run_headless(settings):
+    """Serve until Ctrl+C or SIGTERM; suitable for a service or a scheduled task at boot.
+
+    With more than one worker process, SIGHUP re-reads the settings and
+    replaces the workers without dropping connections.
+    """
+    global FOLDER_SELECTED
+    attach_log()
+    FOLDER_SELECTED = os.path.abspath(settings.get("root") or os.getcwd())
+    if not os.path.isdir(FOLDER_SELECTED):
+        print(f"Not a folder: {FOLDER_SELECTED}")
+        return 2
+    if AUTH_PASSWORD == "password":
+        print("Warning: using the default password; set LANSHARE_PASSWORD or --config")
+    workers = worker_count(settings)
+    started = time.perf_counter()
+    httpd = pool = None
+    try:
+        if workers > 1:
+            pool = WorkerPool(dict(settings, root=FOLDER_SELECTED), workers)
+            pool.start()
+        else:
+            httpd = start_server(FOLDER_SELECTED, settings.get("max_connections", MAX_CONNECTIONS))
+    except OSError as e:
+        print(f"Cannot listen on {BIND_ADDRESS or '*'}:{PORT}: {e}")
+        return 1
+    except RuntimeError as e:
+        print(f"Cannot start the worker processes: {e}")
+        pool.stop()
+        return 1
+    print(f"Sharing {FOLDER_SELECTED} at http://{BIND_ADDRESS or get_ip()}:{PORT} "
+          f"(ready in {(time.perf_counter() - started) * 1000:.0f} ms"
+          + (f", {workers} worker processes)" if pool else ")"))
+
+    stopping = threading.Event()
+    reloading = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, getattr(signal, "SIGBREAK", None)):
+        if signum is not None:
+            signal.signal(signum, lambda *_: stopping.set())
+    if pool is not None and hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda *_: reloading.set())
+    while not stopping.wait(1):  # wake up regularly so Ctrl+C is seen on Windows
+        if pool is None:
+            continue
+        if reloading.is_set():
+            reloading.clear()
+            print("Reloading...")
+            try:
+                new_settings = load_settings(sys.argv[1:])
+            except SystemExit:
+                print("Reload failed, keeping the running workers: invalid settings")
+            else:
+                new_settings["root"] = FOLDER_SELECTED  # changing the shared folder needs a restart
+                if pool.reload(new_settings):
+                    print(f"Reloaded with {pool.count} worker processes")
+        pool.check()
+    print("Stopping...")
+    if pool is not None:
+        pool.stop()
+    else:
+        stop_server(httpd)
+    return 0
+
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # thumbnail workers in the PyInstaller build
+    settings = load_settings(sys.argv[1:])
+    apply_settings(settings)
+    if settings["headless"] or tk is None:
+        sys.exit(run_headless(settings))
     try:
         root = tk.Tk()
         app = App(root)
+        if "max_connections" in settings:
+            app.max_connections_var.set(settings["max_connections"])
         root.mainloop()
     except Exception as e:
         import traceback